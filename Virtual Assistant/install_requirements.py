@@ -15,7 +15,8 @@ def install_packages():
         "torch==2.5.0",
         "PyPDF2==3.0.1",
         "accelerate==0.34.2",
-        "diffusers==0.30.3"
+        "diffusers==0.30.3",
+        "psutil==6.1.0"
     ]
     for package in packages:
         print(f"Installing {package}...")
@@ -1,20 +1,42 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer
-import torch
-
-def install_tinyllama():
-    model_name = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
-    print(f"Downloading TinyLlama-1.1B-Chat model (~2GB) from {model_name}...")
-    try:
-        # Download tokenizer
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
-        print("Tokenizer downloaded successfully.")
-        # Download model
-        model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32, device_map="cpu")
-        print("Model downloaded successfully.")
-    except Exception as e:
-        print(f"Error downloading TinyLlama: {str(e)}")
-        return
-    print("TinyLlama-1.1B-Chat is ready. Run 'python main.py' to start the AI Assistant.")
-
-if __name__ == "__main__":
-    install_tinyllama()
\ No newline at end of file
+import argparse
+import os
+import sys
+from huggingface_hub import snapshot_download
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+# Run from the app folder so main.py finds the registry next to config.json
+os.chdir(APP_DIR)
+sys.path.insert(0, APP_DIR)
+# Repos, file patterns and the registry format come from main.py, so the app always accepts what is installed here
+from main import MODEL_SOURCES, ModelRegistry
+
+DESCRIPTIONS = {
+    "chat": "TinyLlama-1.1B-Chat model (~2GB)",
+    "image": "Stable Diffusion v1.5 model (~4GB)",
+    "clip": "CLIP vision model (~600MB)"
+}
+
+def install_model(name, registry):
+    repo_id, patterns = MODEL_SOURCES[name]
+    print(f"Downloading {DESCRIPTIONS[name]} from {repo_id}...")
+    try:
+        path = snapshot_download(repo_id, allow_patterns=patterns)
+    except Exception as e:
+        print(f"Error downloading {repo_id}: {str(e)}")
+        return False
+    registry.record(name, repo_id, path)
+    print(f"{repo_id} installed at {path} (revision {registry.revision(name)[:12]}).")
+    return True
+
+def install_tinyllama():
+    parser = argparse.ArgumentParser(description="Download OmniCore's models and record them in model_registry.json for offline use.")
+    parser.add_argument("--all", action="store_true", help="also install Stable Diffusion and CLIP")
+    args = parser.parse_args()
+    registry = ModelRegistry()
+    names = list(MODEL_SOURCES) if args.all else ["chat"]
+    if not all(install_model(name, registry) for name in names):
+        return
+    print("TinyLlama-1.1B-Chat is ready. Run 'python main.py' to start the AI Assistant.")
+
+if __name__ == "__main__":
+    install_tinyllama()
@@ -0,0 +1,199 @@
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+# Run from the app folder so main.py finds model_registry.json and its data folders like the GUI does
+os.chdir(APP_DIR)
+sys.path.insert(0, APP_DIR)
+import main
+from main import torch, transformers
+
+# Same proportions as TinyLlama (GQA, SwiGLU), small enough to build in a second with no downloads
+STUB_CONFIG = {"hidden_size": 256, "intermediate_size": 704, "num_hidden_layers": 4, "num_attention_heads": 8,
+               "num_key_value_heads": 2, "max_position_embeddings": main.MODEL_CONTEXT_TOKENS}
+STUB_WORDS = 2000
+
+def build_stub():
+    from tokenizers import Tokenizer, models, pre_tokenizers, decoders, processors
+    words = ["<unk>", "<s>", "<|user|>", "<|assistant|>", "User:", "AI:"] + [f"w{i}" for i in range(STUB_WORDS)]
+    tok = Tokenizer(models.WordLevel(vocab={word: i for i, word in enumerate(words)}, unk_token="<unk>"))
+    tok.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tok.decoder = decoders.WordPiece(prefix="##")
+    tok.post_processor = processors.TemplateProcessing(single="<s> $A", special_tokens=[("<s>", 1)])
+    # EOS gets the id just past the model's vocab, so every run decodes exactly max_new_tokens
+    tokenizer = transformers.PreTrainedTokenizerFast(tokenizer_object=tok, bos_token="<s>", unk_token="<unk>", pad_token="<unk>")
+    tokenizer.add_special_tokens({"eos_token": "</s>"})
+    torch.manual_seed(0)
+    model = transformers.LlamaForCausalLM(transformers.LlamaConfig(vocab_size=len(words), **STUB_CONFIG))
+    return model.eval(), tokenizer, "stub-llama"
+
+def build_tinyllama(precision):
+    registry = main.ModelRegistry(offline=True)
+    path = registry.resolve("chat")
+    tokenizer = transformers.AutoTokenizer.from_pretrained(path, local_files_only=True)
+    model = transformers.AutoModelForCausalLM.from_pretrained(
+        path, torch_dtype=torch.bfloat16 if precision == "bf16" else torch.float32,
+        low_cpu_mem_usage=True, use_safetensors=True, local_files_only=True
+    )
+    return model.eval(), tokenizer, f"{main.CHAT_MODEL_NAME}@{registry.revision('chat')}"
+
+def make_prompt(tokenizer, length, variant):
+    # Distinct prompts per request so batched rows never share a KV prefix by accident
+    if "w0" in tokenizer.get_vocab():
+        return " ".join(f"w{(variant * 7919 + i) % STUB_WORDS}" for i in range(length))
+    text = " ".join(f"Question {variant}: describe step {i} of brewing coffee in detail." for i in range(length))
+    return tokenizer.decode(tokenizer(text, add_special_tokens=False)["input_ids"][:length])
+
+class PendingBatch:
+    # Hands the rest of a batch to BatchGenerator the way InferenceScheduler.take_pending would
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def take_pending(self, kind, limit, accept=None):
+        taken, keep = [], []
+        for job in self.jobs:
+            if job.kind == kind and len(taken) < limit and (accept is None or accept(job.request)):
+                taken.append(job)
+            else:
+                keep.append(job)
+        self.jobs = keep
+        return [job for job in taken if job.future.set_running_or_notify_cancel()]
+
+def run_batch(generator, prompts, max_new_tokens):
+    requests = [main.GenerationRequest(prompt, max_new_tokens, do_sample=False) for prompt in prompts]
+    jobs = [main.InferenceJob(main.InferenceScheduler.PRIORITY_INTERACTIVE, i, "chat", None, request=req)
+            for i, req in enumerate(requests)]
+    finished = {}
+    for req in requests:
+        req.future.add_done_callback(lambda future, req=req: finished.setdefault(id(req), time.time()))
+    generator.scheduler = PendingBatch(jobs[1:])
+    start = time.time()
+    generator.run(requests[0])
+    wall = time.time() - start
+    return [{
+        "prompt_tokens": len(req.input_ids),
+        "output_tokens": len(req.output_ids),
+        "ttft_s": req.first_token_time - start,
+        "latency_s": finished.get(id(req), time.time()) - start
+    } for req in requests], wall
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return None
+
+    def pick(q):
+        return values[min(len(values) - 1, max(0, round(q * (len(values) - 1))))]
+
+    return {"mean": round(statistics.mean(values) * 1000, 2), "p50": round(pick(0.5) * 1000, 2),
+            "p90": round(pick(0.9) * 1000, 2), "p99": round(pick(0.99) * 1000, 2)}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=APP_DIR).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(results, baseline_path):
+    with open(baseline_path, 'r') as f:
+        baseline = {(r["prompt_tokens"], r["batch_size"]): r for r in json.load(f)["results"]}
+    print(f"\nChange vs {baseline_path}:")
+    for r in results:
+        old = baseline.get((r["prompt_tokens"], r["batch_size"]))
+        if not old:
+            continue
+        tps = (r["tokens_per_sec"] / old["tokens_per_sec"] - 1) * 100
+        ttft = (r["ttft_ms"]["p50"] / old["ttft_ms"]["p50"] - 1) * 100
+        print(f"  prompt {r['prompt_tokens']:>5}  batch {r['batch_size']:>2}  tok/s {tps:+6.1f}%  TTFT p50 {ttft:+6.1f}%")
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Benchmark OmniCore's chat generation path (BatchGenerator).")
+    parser.add_argument("--model", choices=["stub", "tinyllama", "auto"], default="auto",
+                        help="stub: tiny random Llama, no downloads; tinyllama: installed model; auto: TinyLlama if installed")
+    parser.add_argument("--precision", choices=["fp32", "bf16", "int8"], default="fp32")
+    parser.add_argument("--prompt-lengths", type=int, nargs="+", default=[16, 128, 512])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--threads", type=int, help="torch intra-op threads (default: all physical cores)")
+    parser.add_argument("--speculative", action="store_true", help="enable prompt-lookup speculative decoding")
+    parser.add_argument("--output", help="JSON results path (default: benchmarks/llm_<model>_<timestamp>.json)")
+    parser.add_argument("--compare", help="earlier results JSON to print relative changes against")
+    args = parser.parse_args()
+
+    use_tinyllama = args.model == "tinyllama" or (args.model == "auto" and main.ModelRegistry().entry("chat"))
+    threads = args.threads or main.machine_signature()["physical_cores"]
+    torch.set_num_threads(threads)
+    model, tokenizer, model_id = build_tinyllama(args.precision) if use_tinyllama else build_stub()
+    if args.precision == "bf16" and not use_tinyllama:
+        model = model.to(torch.bfloat16)
+    if args.precision == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    context = main.ContextManager(tokenizer)
+    generator = main.BatchGenerator(
+        model, tokenizer, main.ChatKVCache(0), lambda chat_id, query, n, history, search_query=None: context.build(None, history or [], query, n),
+        max_batch=max(args.batch_sizes), stats={"precision": args.precision}, model_id=model_id, speculative=args.speculative
+    )
+    print(f"Benchmarking {model_id} ({args.precision}, {threads} threads, {args.max_new_tokens} new tokens, {args.repeats} repeats)")
+    run_batch(generator, [make_prompt(tokenizer, 16, 0)], 4)  # warm-up
+
+    results = []
+    for prompt_length in args.prompt_lengths:
+        for batch_size in args.batch_sizes:
+            samples, walls, generated = [], [], 0
+            stats = {}
+            with main.measure_load(stats):
+                for repeat in range(args.repeats):
+                    prompts = [make_prompt(tokenizer, prompt_length, repeat * batch_size + i) for i in range(batch_size)]
+                    rows, wall = run_batch(generator, prompts, args.max_new_tokens)
+                    samples += rows
+                    walls.append(wall)
+                    generated += sum(row["output_tokens"] for row in rows)
+            result = {
+                "prompt_tokens": prompt_length,
+                "batch_size": batch_size,
+                "actual_prompt_tokens": round(statistics.mean(row["prompt_tokens"] for row in samples)),
+                "ttft_ms": percentiles([row["ttft_s"] for row in samples]),
+                "latency_ms": percentiles([row["latency_s"] for row in samples]),
+                "tokens_per_sec": round(generated / sum(walls), 2),
+                "per_request_tokens_per_sec": round(statistics.mean(
+                    row["output_tokens"] / row["latency_s"] for row in samples if row["latency_s"] > 0), 2),
+                "peak_rss_mb": stats["peak_rss_mb"]
+            }
+            results.append(result)
+            print(f"  prompt {prompt_length:>5}  batch {batch_size:>2}  TTFT p50 {result['ttft_ms']['p50']:8.1f} ms  "
+                  f"latency p90 {result['latency_ms']['p90']:8.1f} ms  {result['tokens_per_sec']:8.1f} tok/s  "
+                  f"peak RSS {result['peak_rss_mb']} MB")
+
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "model": model_id,
+            "precision": args.precision,
+            "threads": threads,
+            "max_new_tokens": args.max_new_tokens,
+            "repeats": args.repeats,
+            "speculative": args.speculative,
+            "machine": main.machine_signature(),
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "git_commit": git_commit()
+        },
+        "results": results
+    }
+    output = args.output or os.path.join("benchmarks", f"llm_{'tinyllama' if use_tinyllama else 'stub'}_{datetime.datetime.now():%Y%m%d_%H%M%S}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f"Results written to {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -5,52 +5,429 @@ import os  # Added for os.makedirs, os.path, etc.
 import shutil
 from PIL import Image, ImageTk
 import datetime
-from transformers import AutoModelForCausalLM, AutoTokenizer, CLIPProcessor, CLIPModel
-import torch
-import PyPDF2
 import threading
+import asyncio
+import base64
+import io
+import uuid
+from http import HTTPStatus
+import queue
+import heapq
+import itertools
 import time
-from diffusers import StableDiffusionPipeline
-import cv2  # Added for OpenCV functionality
-import numpy as np
-import pygame
 import random
+import importlib
+import hashlib
+import gc
+import contextlib
+import statistics
+import re
+import math
+import sqlite3
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
 from pathlib import Path  # Added for Path in VideoApp
 
+class LazyModule:
+    # Stands in for a heavy package until its first attribute access, so the settings and main
+    # windows paint before torch, transformers, diffusers, OpenCV or PyPDF2 are imported
+    def __init__(self, name):
+        self._lazy_name = name
+        self._lazy_module = None
+
+    def __getattr__(self, attr):
+        if self._lazy_module is None:
+            self._lazy_module = importlib.import_module(self._lazy_name)
+        return getattr(self._lazy_module, attr)
+
+torch = LazyModule("torch")
+transformers = LazyModule("transformers")
+diffusers = LazyModule("diffusers")
+cv2 = LazyModule("cv2")  # Added for OpenCV functionality
+np = LazyModule("numpy")
+PyPDF2 = LazyModule("PyPDF2")
+
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+
 try:
     import tkinterdnd2 as tkdnd
     TKDND_AVAILABLE = True
 except ImportError:
     TKDND_AVAILABLE = False
-    tk.messagebox.showwarning("Warning", "tkinterdnd2 not found. Drag-and-drop disabled.")
+    try:
+        tk.messagebox.showwarning("Warning", "tkinterdnd2 not found. Drag-and-drop disabled.")
+    except tk.TclError:
+        # No display, e.g. the command-line benchmarks
+        print("Warning: tkinterdnd2 not found. Drag-and-drop disabled.")
 
 ATTACHMENTS_DIR = "attachments"
 GENERATED_IMAGES_DIR = "generated_images"
 CHAT_HISTORY_FILE = "chat_history.json"
+CHAT_DB_FILE = "chats.db"
 CONFIG_FILE = "config.json"
 VIDEO_TEMP_DIR = "C:/VideoAppTempFiles"
+MODEL_CONTEXT_TOKENS = 2048
+SUMMARY_TOKEN_BUDGET = 256
+CHAT_MODEL_NAME = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
+RESPONSE_CACHE_DIR = "response_cache"
+RETRIEVAL_INDEX_DIR = "retrieval_index"
+RETRIEVAL_TOKEN_BUDGET = 512
+IMAGE_INDEX_DIR = "image_index"
+IMAGE_CACHE_DIR = "image_cache"
+PROMPT_EMBED_CACHE_SIZE = 32
+CHAT_SEARCH_DB = "chat_search.db"
+MODEL_REGISTRY_FILE = "model_registry.json"
+# Hub repo and the files each capability needs; install_tinyllama.py imports these
+MODEL_SOURCES = {
+    "chat": (CHAT_MODEL_NAME, ["*.json", "tokenizer.model", "*.safetensors"]),
+    "image": ("runwayml/stable-diffusion-v1-5", [
+        "model_index.json", "scheduler/*", "tokenizer/*", "feature_extractor/*",
+        "text_encoder/config.json", "text_encoder/model.safetensors",
+        "unet/config.json", "unet/diffusion_pytorch_model.safetensors",
+        "vae/config.json", "vae/diffusion_pytorch_model.safetensors",
+        "safety_checker/config.json", "safety_checker/model.safetensors"
+    ]),
+    "clip": ("openai/clip-vit-base-patch32", ["*.json", "*.txt", "*.safetensors"])
+}
 
 os.makedirs(ATTACHMENTS_DIR, exist_ok=True)
 os.makedirs(GENERATED_IMAGES_DIR, exist_ok=True)
 os.makedirs(VIDEO_TEMP_DIR, exist_ok=True)
 
-def initialize_chat_history():
-    default_history = {"chats": {}}
-    if not os.path.exists(CHAT_HISTORY_FILE):
-        with open(CHAT_HISTORY_FILE, 'w') as f:
-            json.dump(default_history, f)
-    else:
-        try:
-            with open(CHAT_HISTORY_FILE, 'r') as f:
-                data = json.load(f)
-                if not isinstance(data, dict) or "chats" not in data:
-                    with open(CHAT_HISTORY_FILE, 'w') as f:
-                        json.dump(default_history, f)
-        except json.JSONDecodeError:
-            with open(CHAT_HISTORY_FILE, 'w') as f:
-                json.dump(default_history, f)
+def get_rss_mb():
+    if PSUTIL_AVAILABLE:
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return 0.0
+
+class ProgressTracker:
+    # Progress driven by real work events (shards, tokens, denoising steps, frames, pages);
+    # the ETA extrapolates the measured rate over the work that is left
+    MIN_INTERVAL = 0.1
+
+    def __init__(self, task_name, total, on_status, unit=""):
+        self.task_name = task_name
+        self.total = total
+        self.on_status = on_status
+        self.unit = unit
+        self.done = 0
+        self.start_time = time.time()
+        self.last_report = 0.0
+        self.report(force=True)
+
+    def set_total(self, total):
+        self.total = total
+
+    def update(self, done, total=None):
+        if total is not None:
+            self.total = total
+        self.done = done
+        self.report(force=self.done >= self.total)
+
+    def advance(self, count=1):
+        self.update(self.done + count)
+
+    def iterate(self, items):
+        for item in items:
+            yield item
+            self.advance()
+
+    def eta(self):
+        if not self.done or self.done >= self.total:
+            return None
+        return round((time.time() - self.start_time) / self.done * (self.total - self.done), 1)
+
+    def report(self, force=False):
+        # Throttled so a fast loop does not flood the Tk event queue
+        now = time.time()
+        if not force and now - self.last_report < self.MIN_INTERVAL:
+            return
+        self.last_report = now
+        counts = f" ({self.done}/{self.total}{' ' + self.unit if self.unit else ''})" if self.total else ""
+        self.on_status(f"{self.task_name}{counts}", min(100.0, self.done / self.total * 100) if self.total else 0, self.eta())
+
+    def finish(self, message="Ready"):
+        self.on_status(message, 100, 0)
+
+@contextlib.contextmanager
+def hf_load_progress(tracker, library="transformers"):
+    # transformers walks checkpoint shards and diffusers walks pipeline components through their
+    # logging.tqdm wrappers; swapping those for the length of a load turns each item into an event.
+    # diffusers is only imported for a diffusers load (its pipelines also load transformers parts)
+    from transformers.utils import logging as transformers_logging
+    modules = [transformers_logging]
+    if library == "diffusers":
+        from diffusers.utils import logging as diffusers_logging
+        modules.append(diffusers_logging)
+    originals = [(module, module.tqdm) for module in modules]
+
+    def tracked(iterable=None, *args, **kwargs):
+        if iterable is None:
+            return originals[0][1](*args, **kwargs)
+        items = list(iterable)
+        tracker.set_total(tracker.total + len(items))
+        return tracker.iterate(items)
+
+    for module, _ in originals:
+        module.tqdm = tracked
+    try:
+        yield tracker
+    finally:
+        for module, original in originals:
+            module.tqdm = original
+
+@contextlib.contextmanager
+def measure_load(stats, interval=0.05):
+    # The OS peak-RSS counters never reset, so sample on a side thread for the length of one load
+    stop = threading.Event()
+    start = time.time()
+    stats["peak_rss_mb"] = get_rss_mb()
+
+    def sample():
+        while not stop.wait(interval):
+            stats["peak_rss_mb"] = max(stats["peak_rss_mb"], get_rss_mb())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        yield stats
+    finally:
+        stop.set()
+        sampler.join()
+        stats["load_seconds"] = round(time.time() - start, 1)
+        stats["rss_mb"] = round(get_rss_mb())
+        stats["peak_rss_mb"] = round(max(stats["peak_rss_mb"], stats["rss_mb"]))
+
+def module_size_mb(*modules):
+    total = 0
+    for module in modules:
+        if isinstance(module, torch.nn.Module):
+            total += sum(t.numel() * t.element_size() for t in itertools.chain(module.parameters(), module.buffers()))
+    return total / (1024 * 1024)
+
+def choose_ram_budget_mb(config):
+    budget = config.get("model_ram_budget_mb", "Auto")
+    if isinstance(budget, (int, float)) and budget > 0:
+        return budget
+    if PSUTIL_AVAILABLE:
+        # Leave room for the OS, the UI and activations
+        return psutil.virtual_memory().total / (1024 * 1024) * 0.6
+    return 8192
+
+WEIGHT_MB = {"fp32": 4400, "bf16": 2200, "int8": 1400}
+TINYLLAMA_SHAPE = {"hidden_size": 2048, "intermediate_size": 5632, "num_attention_heads": 32, "num_key_value_heads": 4,
+                   "num_hidden_layers": 22, "vocab_size": 32000}
+SD_UNET_STEP_GFLOP = 1600  # one classifier-free-guidance UNet step (batch of 2) at 512x512
+CALIBRATION_VERSION = 1
+# What each power level is willing to wait for; calibration turns these into concrete settings per machine
+POWER_TARGETS = {
+    "Eco": {"reply_seconds": 15, "image_seconds": 45, "min_steps": 10, "max_steps": 15, "max_size": 384},
+    "Balanced": {"reply_seconds": 30, "image_seconds": 90, "min_steps": 15, "max_steps": 25, "max_size": 512},
+    "Max": {"reply_seconds": 60, "image_seconds": 180, "min_steps": 20, "max_steps": 30, "max_size": 512}
+}
+# How the Stable Diffusion pipeline is set up. DPM-Solver++ (multistep) matches the default PNDM scheduler
+# in about half the steps, so it also caps them. Attention slicing and VAE slicing/tiling lower the peak RSS of
+# a run at some speed cost. channels_last and bf16 only pay off on CPUs with fast bf16 (AVX512-BF16/AMX),
+# which calibration already measures.
+IMAGE_PRESETS = {
+    "Low Memory": {"scheduler": "dpm++", "max_steps": 20, "attention_slicing": "max", "vae_slicing": True, "vae_tiling": True,
+                   "channels_last": False, "bf16": False},
+    "Fast": {"scheduler": "dpm++", "max_steps": 12, "attention_slicing": None, "vae_slicing": True, "vae_tiling": False,
+             "channels_last": True, "bf16": True},
+    "Balanced": {"scheduler": "dpm++", "max_steps": 20, "attention_slicing": "auto", "vae_slicing": True, "vae_tiling": False,
+                 "channels_last": True, "bf16": True},
+    "Quality": {"scheduler": "default", "max_steps": None, "attention_slicing": None, "vae_slicing": False, "vae_tiling": False,
+                "channels_last": True, "bf16": False}
+}
+
+def machine_signature():
+    logical = os.cpu_count() or 1
+    physical = (psutil.cpu_count(logical=False) if PSUTIL_AVAILABLE else None) or logical
+    ram_mb = round(psutil.virtual_memory().total / (1024 * 1024)) if PSUTIL_AVAILABLE else 8192
+    return {"logical_cores": logical, "physical_cores": physical, "ram_mb": ram_mb}
+
+def median_seconds(fn, repeats):
+    fn()  # warm-up
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
 
-initialize_chat_history()
+def decoder_params(layers, vocab_size):
+    h = TINYLLAMA_SHAPE["hidden_size"]
+    kv = h * TINYLLAMA_SHAPE["num_key_value_heads"] // TINYLLAMA_SHAPE["num_attention_heads"]
+    return layers * (2 * h * h + 2 * h * kv + 3 * h * TINYLLAMA_SHAPE["intermediate_size"]) + vocab_size * h
+
+def benchmark_decode(precision):
+    # One TinyLlama-shaped decoder layer with a small vocab; decoding is bound by weight reads,
+    # so the per-token time scales to the full model by parameter count
+    vocab_size = 4096
+    config = transformers.LlamaConfig(**dict(TINYLLAMA_SHAPE, num_hidden_layers=1, vocab_size=vocab_size))
+    torch.manual_seed(0)
+    model = transformers.LlamaForCausalLM(config).eval()
+    if precision == "bf16":
+        model = model.to(torch.bfloat16)
+    elif precision == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    with torch.inference_mode():
+        cache = model(input_ids=torch.randint(0, vocab_size, (1, 128)), past_key_values=transformers.DynamicCache(), use_cache=True).past_key_values
+        token = torch.tensor([[1]])
+        seconds = median_seconds(lambda: model(input_ids=token, past_key_values=cache, use_cache=True), 8)
+    return seconds * decoder_params(TINYLLAMA_SHAPE["num_hidden_layers"], TINYLLAMA_SHAPE["vocab_size"]) / decoder_params(1, vocab_size)
+
+def benchmark_unet_gflops():
+    # A 320-channel 3x3 conv at SD's top latent resolution, the UNet's dominant op
+    conv = torch.nn.Conv2d(320, 320, 3, padding=1).eval()
+    latents = torch.randn(2, 320, 64, 64)
+    with torch.inference_mode():
+        seconds = median_seconds(lambda: conv(latents), 3)
+    return 2 * 320 * 320 * 9 * 64 * 64 * 2 / seconds / 1e9
+
+def derive_profiles(machine, seconds_per_token, unet_gflops):
+    profiles = {}
+    physical = machine["physical_cores"]
+    threads_by_level = {"Eco": max(1, physical // 2), "Balanced": max(1, physical - 1 if physical > 2 else physical), "Max": physical}
+    for level, target in POWER_TARGETS.items():
+        threads = threads_by_level[level]
+        # Benchmarks ran on every physical core; fewer threads are assumed to scale linearly
+        scale = threads / physical
+        affordable = [p for p in ("fp32", "bf16", "int8") if WEIGHT_MB[p] <= machine["ram_mb"] * 0.5] or ["int8"]
+        speed = {p: scale / seconds_per_token[p] for p in affordable}
+        fastest = max(speed, key=speed.get)
+        if level == "Eco":
+            precision = "int8" if speed.get("int8", 0) * 2 >= speed[fastest] else fastest
+        elif level == "Balanced":
+            precision = fastest
+        else:
+            precision = "fp32" if speed.get("fp32", 0) >= 3 else fastest
+        step_seconds = {size: SD_UNET_STEP_GFLOP * (size / 512) ** 2 / (unet_gflops * scale) for size in (512, 448, 384, 320, 256)}
+        size, steps = 256, target["min_steps"]
+        for candidate in (512, 448, 384, 320, 256):
+            fits = int(target["image_seconds"] / step_seconds[candidate])
+            if candidate <= target["max_size"] and fits >= target["min_steps"]:
+                size, steps = candidate, min(fits, target["max_steps"])
+                break
+        profiles[level] = {
+            "torch_threads": threads,
+            "interop_threads": 2 if level == "Max" and physical >= 8 else 1,
+            "dtype": precision,
+            "tokens_per_sec": round(speed[precision], 1),
+            "max_new_tokens": min(512, max(64, int(target["reply_seconds"] * speed[precision]) // 32 * 32)),
+            "diffusion_steps": steps,
+            "image_size": size,
+            "seconds_per_step": round(step_seconds[size], 2)
+        }
+    return profiles
+
+def calibrate_hardware(on_status=None):
+    machine = machine_signature()
+    tracker = ProgressTracker("Calibrating hardware", 4, on_status) if on_status else None
+    # Benchmarks run on every physical core; the caller's setting (e.g. a pinned "torch_threads") is put back after
+    previous_threads = torch.get_num_threads()
+    torch.set_num_threads(machine["physical_cores"])
+    try:
+        seconds_per_token = {}
+        for precision in ("fp32", "bf16", "int8"):
+            seconds_per_token[precision] = benchmark_decode(precision)
+            if tracker:
+                tracker.advance()
+        unet_gflops = benchmark_unet_gflops()
+        if tracker:
+            tracker.advance()
+    finally:
+        torch.set_num_threads(previous_threads)
+    return {
+        "version": CALIBRATION_VERSION,
+        "calibrated": datetime.datetime.now().isoformat(timespec="seconds"),
+        "machine": machine,
+        "seconds_per_token": {p: round(value, 4) for p, value in seconds_per_token.items()},
+        "unet_gflops": round(unet_gflops, 1),
+        "profiles": derive_profiles(machine, seconds_per_token, unet_gflops)
+    }
+
+def calibration_current(config):
+    calibration = config.get("calibration") or {}
+    return calibration.get("version") == CALIBRATION_VERSION and calibration.get("machine") == machine_signature()
+
+def active_profile(config):
+    # Low PC Mode always runs the Eco profile, whatever the power level says
+    level = "Eco" if config.get("performance_mode") == "Low" else config.get("power_level", "Balanced")
+    return ((config.get("calibration") or {}).get("profiles") or {}).get(level)
+
+def choose_image_preset(config):
+    if config.get("image_preset") in IMAGE_PRESETS:
+        return config["image_preset"]
+    level = "Eco" if config.get("performance_mode") == "Low" else config.get("power_level", "Balanced")
+    if level == "Eco":
+        return "Low Memory"
+    if config.get("image_quality") == "Low":
+        return "Fast"
+    return "Quality" if level == "Max" else "Balanced"
+
+def image_bf16_supported(config):
+    # Calibration times a bf16 decoder layer; bf16 is only worth it where it clearly beat fp32
+    seconds = (config.get("calibration") or {}).get("seconds_per_token") or {}
+    return bool(seconds.get("bf16")) and seconds["bf16"] < seconds.get("fp32", 0) * 0.8
+
+def preset_variant(config, preset_name):
+    # The scheduler and dtype a pipeline loaded under this preset renders with; part of the image cache key
+    preset = IMAGE_PRESETS[preset_name]
+    return f"{preset['scheduler']}:{'bf16' if preset['bf16'] and image_bf16_supported(config) else 'fp32'}"
+
+def choose_image_settings(config):
+    profile = active_profile(config)
+    steps, size = (profile["diffusion_steps"], profile["image_size"]) if profile else (20, 512)
+    max_steps = IMAGE_PRESETS[choose_image_preset(config)]["max_steps"]
+    if max_steps:
+        # DPM-Solver++ presets already trade steps for speed; halving on top would cost visible quality
+        steps = min(steps, max_steps)
+    elif config.get("image_quality") == "Low":
+        steps = max(8, steps // 2)
+    return steps, size
+
+def parse_image_prompt(text):
+    # "a cat | a dog seed:7" -> (["a cat", "a dog"], 7); each |-separated prompt is its own batch entry
+    match = re.search(r"\bseed\s*[:=]\s*(\d+)", text, re.I)
+    seed = None
+    if match:
+        seed = int(match.group(1))
+        text = text[:match.start()] + text[match.end():]
+    return [part.strip() for part in text.split("|") if part.strip()], seed
+
+def image_grid(paths, tile=160):
+    # One preview for a batch, so the chat holds a single PhotoImage instead of one per result
+    cols = math.ceil(math.sqrt(len(paths)))
+    rows = math.ceil(len(paths) / cols)
+    grid = Image.new("RGB", (cols * tile, rows * tile), "white")
+    for i, path in enumerate(paths):
+        with Image.open(path) as img:
+            img.thumbnail((tile, tile))
+            grid.paste(img, ((i % cols) * tile + (tile - img.width) // 2, (i // cols) * tile + (tile - img.height) // 2))
+    return grid
+
+def choose_model_precision(config):
+    # "Auto" uses the calibrated profile, or maps the power/performance settings onto a weight format
+    precision = config.get("model_precision", "Auto")
+    if precision in ("fp32", "bf16", "int8"):
+        return precision
+    profile = active_profile(config)
+    if profile:
+        return profile["dtype"]
+    if config.get("performance_mode") == "Low" or config.get("power_level") == "Eco":
+        return "int8"
+    if config.get("power_level") == "Balanced":
+        return "bf16"
+    return "fp32"
 
 class SettingsGUI:
     def __init__(self, root, callback):
@@ -66,7 +443,31 @@ class SettingsGUI:
             "performance_mode": "High",
             "image_quality": "High",
             "max_chat_length": "Long",
-            "power_level": "Balanced"  # Ensure power_level is included
+            "power_level": "Balanced",  # Ensure power_level is included
+            "kv_cache_mb": 512,
+            "model_precision": "Auto",
+            "max_queued_jobs": 8,
+            "torch_threads": None,
+            "max_batch_size": 4,
+            "deterministic_mode": "Off",
+            "response_seed": 42,
+            "image_batch_size": 2,
+            "image_preset": "Auto",
+            "response_cache_mb": 64,
+            "image_cache_mb": 256,
+            "image_negative_prompt": "",
+            "api_server": False,
+            "api_port": 8765,
+            "api_max_concurrent": 2,
+            "speculative_decoding": True,
+            "draft_model_path": "",
+            "model_ram_budget_mb": "Auto",
+            "model_idle_minutes": 10,
+            "offline_mode": False,
+            "retrieval_top_k": 4,
+            "retrieval_embeddings": False,
+            "chat_cache_size": 16,
+            "calibration": None
         }
         if os.path.exists(CONFIG_FILE):
             try:
@@ -245,8 +646,9 @@ class SnakeGame:
         self.on_exit()
 
 class VideoApp:
-    def __init__(self, parent_frame):
+    def __init__(self, parent_frame, on_status=None):
         self.parent_frame = parent_frame
+        self.on_status = on_status
         self.temp_folder = Path(VIDEO_TEMP_DIR)
         self.cap = None
         self.duration = 0
@@ -405,6 +807,12 @@ class VideoApp:
         self.fps_entry.grid(row=2, column=1, padx=10, pady=10, sticky="w")
         tk.Button(self.settings_tab, text="Apply FPS", command=self.update_fps).grid(row=2, column=2, padx=10)
 
+    def show_progress(self, message, progress, estimated_time=None):
+        # Video loops run on the Tk thread, so let the status bar repaint between reports
+        if self.on_status:
+            self.on_status(message, progress, estimated_time)
+        self.parent_frame.update()
+
     def editor_load_video(self):
         file_path = filedialog.askopenfilename(filetypes=[("Video files", "*.mp4 *.mkv *.avi")])
         if not file_path:
@@ -477,10 +885,12 @@ class VideoApp:
                 raise Exception("Can't initialize video writer.")
             
             self.cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+            tracker = ProgressTracker("Saving edited video", end_frame - start_frame, self.show_progress, "frames")
             for i in range(start_frame, end_frame):
                 ret, frame = self.cap.read()
                 if not ret:
                     break
+                tracker.advance()
                 frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
                 frame = frame[y:y+h, x:x+w]
                 frame = frame * contrast + brightness
@@ -491,8 +901,10 @@ class VideoApp:
                 out.write(frame)
             
             out.release()
+            tracker.finish()
             tk.messagebox.showinfo("Success", "Video edited and saved.")
         except Exception as e:
+            self.show_progress("Ready", 0)
             tk.messagebox.showerror("Error", f"Save failed: {str(e)}")
 
     def merger_handle_drop(self, event):
@@ -581,8 +993,12 @@ class VideoApp:
             if not out.isOpened():
                 raise Exception("Can't initialize video writer.")
             
-            processed_frames = 0
-            self.merger_progress['maximum'] = total_frames
+            def show_merge_progress(message, progress, estimated_time=None):
+                self.merger_progress['value'] = progress
+                self.show_progress(message, progress, estimated_time)
+
+            self.merger_progress['maximum'] = 100
+            tracker = ProgressTracker("Merging videos", total_frames, show_merge_progress, "frames")
             for video in self.videos:
                 cap = cv2.VideoCapture(str(self.temp_folder / os.path.basename(video)))
                 while True:
@@ -592,16 +1008,16 @@ class VideoApp:
                     if self.scale_factor != 1.0:
                         frame = cv2.resize(frame, (width, height))
                     out.write(frame)
-                    processed_frames += 1
-                    self.merger_progress['value'] = processed_frames
-                    self.parent_frame.update()
+                    tracker.advance()
                 cap.release()
             
             out.release()
             self.merger_progress['value'] = 0
+            tracker.finish()
             tk.messagebox.showinfo("Success", "Videos merged successfully.")
         except Exception as e:
             self.merger_progress['value'] = 0
+            self.show_progress("Ready", 0)
             tk.messagebox.showerror("Error", f"Merge failed: {str(e)}")
 
     def splitter_load_video(self):
@@ -672,6 +1088,7 @@ class VideoApp:
                     splits.append((splits[-1][1], frame_count))
             
             fourcc = cv2.VideoWriter_fourcc(*self.codec)
+            tracker = ProgressTracker("Splitting video", sum(end - start for start, end in splits), self.show_progress, "frames")
             for idx, (start_frame, end_frame) in enumerate(splits):
                 output_file = os.path.join(output_path, f"part_{idx + 1}.mp4")
                 out = cv2.VideoWriter(output_file, fourcc, fps, (width, height))
@@ -686,10 +1103,13 @@ class VideoApp:
                     if self.scale_factor != 1.0:
                         frame = cv2.resize(frame, (width, height))
                     out.write(frame)
+                    tracker.advance()
                 out.release()
             
+            tracker.finish()
             tk.messagebox.showinfo("Success", "Video split successfully.")
         except Exception as e:
+            self.show_progress("Ready", 0)
             tk.messagebox.showerror("Error", f"Split failed: {str(e)}")
 
     def update_codec(self):
@@ -740,6 +1160,1978 @@ class VideoApp:
             self.cap.release()
         self.delete_temp_files()
 
+class ChatKVCache:
+    # Keeps each chat's past_key_values so a new turn only prefills the tokens after the shared prefix
+    def __init__(self, max_mb=512):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def cache_bytes(cache):
+        total = 0
+        for layer in cache.key_cache + cache.value_cache:
+            total += layer.numel() * layer.element_size()
+        return total
+
+    def take(self, chat_id, input_ids):
+        # Pops the entry so two turns of the same chat never mutate one cache concurrently
+        with self.lock:
+            entry = self.entries.pop(chat_id, None)
+        if entry is None:
+            return None, 0
+        token_ids, cache = entry
+        shared = 0
+        for cached_id, new_id in zip(token_ids, input_ids):
+            if cached_id != new_id:
+                break
+            shared += 1
+        # At least one prompt token must be fed to the model to get the next-token logits
+        shared = min(shared, len(input_ids) - 1)
+        if shared <= 0:
+            return None, 0
+        cache.crop(shared)
+        return cache, shared
+
+    def put(self, chat_id, token_ids, cache):
+        with self.lock:
+            self.entries.pop(chat_id, None)
+            self.entries[chat_id] = (token_ids, cache)
+            total = sum(self.cache_bytes(c) for _, c in self.entries.values())
+            while total > self.max_bytes and self.entries:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                total -= self.cache_bytes(evicted)
+
+    def drop(self, chat_id=None):
+        with self.lock:
+            if chat_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(chat_id, None)
+
+class ContextManager:
+    # Fits a chat into the context window: token counts are computed once per message, and the
+    # oldest turns are folded into a short running summary when the history no longer fits
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.counts = {}
+        self.summaries = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def format_turn(msg):
+        tag = {"User": "<|user|>", "System": "<|system|>"}.get(msg["role"], "<|assistant|>")
+        return f"{tag} {msg['content']} "
+
+    @staticmethod
+    def summarize_turn(msg):
+        first = re.split(r"(?<=[.!?])\s", msg["content"].strip(), maxsplit=1)[0]
+        words = first.split()
+        if len(words) > 24:
+            first = " ".join(words[:24]) + "..."
+        return f"{msg['role']}: {first}"
+
+    def count(self, text):
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def message_counts(self, chat_id, messages):
+        counts = self.counts.setdefault(chat_id, [])
+        if len(counts) > len(messages):
+            del counts[:]
+        for msg in messages[len(counts):]:
+            counts.append(self.count(self.format_turn(msg)))
+        return counts
+
+    def summary_text(self, lines):
+        if not lines:
+            return ""
+        return f"<|system|> Earlier in this conversation: {' '.join(lines)} "
+
+    def fold(self, summary, messages, upto):
+        summary["lines"].append(self.summarize_turn(messages[upto]))
+        summary["upto"] = upto + 1
+
+    def passage_text(self, passages):
+        # Best-ranked passages first, up to RETRIEVAL_TOKEN_BUDGET
+        lines = []
+        for passage in passages or []:
+            line = f"[{len(lines) + 1}] ({passage['source']}) {passage['text']}"
+            if self.count(" ".join(lines + [line])) > RETRIEVAL_TOKEN_BUDGET:
+                break
+            lines.append(line)
+        if not lines:
+            return ""
+        return f"<|system|> Passages from the user's files and chats; use them where relevant and cite them as [n]: {' '.join(lines)} "
+
+    def build(self, chat_id, messages, query, max_new_tokens, passages=None):
+        with self.lock:
+            budget = MODEL_CONTEXT_TOKENS - max_new_tokens
+            # Passages go right before the question so the history prefix (and its KV cache) is unchanged
+            current = f"{self.passage_text(passages)}<|user|> {query} <|assistant|> "
+            if chat_id:
+                counts = self.message_counts(chat_id, messages)
+                summary = self.summaries.setdefault(chat_id, {"upto": 0, "lines": [], "tokens": 0})
+            else:
+                # One-off conversations (e.g. API calls) get no cached state
+                counts = [self.count(self.format_turn(msg)) for msg in messages]
+                summary = {"upto": 0, "lines": [], "tokens": 0}
+            if summary["upto"] > len(messages):
+                summary.update(upto=0, lines=[], tokens=0)
+            total = 1 + summary["tokens"] + sum(counts[summary["upto"]:]) + self.count(current)
+            if total > budget:
+                # Fold down to 75% of the budget so the prompt prefix (and its KV cache) stays
+                # stable for several turns instead of shifting on every message
+                target = int(budget * 0.75)
+                while total > target and summary["upto"] < len(messages):
+                    total -= counts[summary["upto"]]
+                    self.fold(summary, messages, summary["upto"])
+                while summary["lines"] and self.count(self.summary_text(summary["lines"])) > SUMMARY_TOKEN_BUDGET:
+                    summary["lines"].pop(0)
+                summary["tokens"] = self.count(self.summary_text(summary["lines"]))
+            turns = [self.format_turn(msg) for msg in messages[summary["upto"]:]]
+            input_ids = self.tokenizer(self.summary_text(summary["lines"]) + "".join(turns) + current)["input_ids"]
+            # Token counts of separately encoded turns can drift by a token or two at the seams
+            while len(input_ids) > budget and summary["upto"] < len(messages):
+                self.fold(summary, messages, summary["upto"])
+                turns = turns[1:]
+                input_ids = self.tokenizer(self.summary_text(summary["lines"]) + "".join(turns) + current)["input_ids"]
+            if len(input_ids) > budget:
+                input_ids = input_ids[:1] + input_ids[-(budget - 1):]
+            return input_ids
+
+    def reset(self, chat_id=None):
+        with self.lock:
+            if chat_id is None:
+                self.counts.clear()
+                self.summaries.clear()
+            else:
+                self.counts.pop(chat_id, None)
+                self.summaries.pop(chat_id, None)
+
+class ResponseCache:
+    # On-disk LRU of finished replies for deterministic (greedy or fixed-seed) generation
+    def __init__(self, cache_dir, max_mb=64):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # Hits only reorder the LRU; that is written with the next put, eviction or flush()
+        self.dirty = False
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = OrderedDict()
+        try:
+            with open(self.index_path, 'r') as f:
+                data = json.load(f)
+            for key, size in sorted(data.get("entries", {}).items(), key=lambda item: item[1]["last_used"]):
+                self.index[key] = size
+        except (OSError, json.JSONDecodeError, KeyError, TypeError):
+            self.index = OrderedDict()
+
+    @staticmethod
+    def make_key(model_id, input_ids, max_new_tokens, sampling):
+        payload = json.dumps([model_id, list(input_ids), max_new_tokens, sampling], separators=(",", ":"))
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.index:
+                self.misses += 1
+                return None
+            try:
+                entry = self.read_entry(key)
+            except (OSError, json.JSONDecodeError):
+                self.index.pop(key, None)
+                self.save_index()
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.index.move_to_end(key)
+            self.index[key]["last_used"] = time.time()
+            self.dirty = True
+            return entry
+
+    def read_entry(self, key):
+        with open(self.entry_path(key), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def put(self, key, response, output_ids):
+        with self.lock:
+            data = json.dumps({"response": response, "output_ids": output_ids})
+            tmp_path = self.entry_path(key) + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, self.entry_path(key))
+            self.index.pop(key, None)
+            self.index[key] = {"size": len(data.encode("utf-8")), "last_used": time.time()}
+            self.evict()
+            self.save_index()
+
+    def evict(self):
+        total = sum(entry["size"] for entry in self.index.values())
+        while total > self.max_bytes and len(self.index) > 1:
+            old_key, old_entry = self.index.popitem(last=False)
+            total -= old_entry["size"]
+            try:
+                os.remove(self.entry_path(old_key))
+            except OSError:
+                pass
+
+    def save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"entries": self.index}, f)
+        os.replace(tmp_path, self.index_path)
+        self.dirty = False
+
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                self.save_index()
+
+    def clear(self):
+        with self.lock:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.index = OrderedDict()
+            self.hits = 0
+            self.misses = 0
+            self.dirty = False
+
+class ImageResultCache(ResponseCache):
+    # Generated images as PNGs, keyed by everything that fixes their pixels, under the same size-bounded LRU
+    @staticmethod
+    def make_key(model_id, prompt, negative_prompt, seed, steps, scheduler, size):
+        payload = json.dumps([model_id, prompt, negative_prompt, seed, steps, scheduler, size], separators=(",", ":"))
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.png")
+
+    def read_entry(self, key):
+        with Image.open(self.entry_path(key)) as img:
+            return img.copy()
+
+    def put(self, key, image):
+        with self.lock:
+            tmp_path = self.entry_path(key) + ".tmp"
+            image.save(tmp_path, format="PNG")
+            os.replace(tmp_path, self.entry_path(key))
+            self.index.pop(key, None)
+            self.index[key] = {"size": os.path.getsize(self.entry_path(key)), "last_used": time.time()}
+            self.evict()
+            self.save_index()
+
+def normalize_prompt(text):
+    # CLIP's tokenizer lowercases and collapses whitespace, so prompts differing only in those encode identically
+    return " ".join(text.lower().split())
+
+def read_attachment_text(file_path, on_status=None):
+    # Plain text of a TXT or PDF attachment; None for files without text (images)
+    file_ext = os.path.splitext(file_path)[1].lower()
+    if file_ext == ".txt":
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return f.read()
+    if file_ext == ".pdf":
+        with open(file_path, 'rb') as f:
+            reader = PyPDF2.PdfReader(f)
+            pages = reader.pages
+            if on_status:
+                pages = ProgressTracker(f"Reading {os.path.basename(file_path)}", len(reader.pages), on_status, "pages").iterate(pages)
+            return "".join(page.extract_text() or "" for page in pages)
+    return None
+
+class RetrievalIndex:
+    # Local retrieval over attachments and chat messages: text is cut into overlapping word windows,
+    # scored with BM25 from an inverted index, and optionally blended with dense vectors kept in one
+    # NumPy matrix. Sources are re-indexed incrementally; removed chunks stay as tombstones until the
+    # next save compacts them away.
+    CHUNK_WORDS = 120
+    CHUNK_OVERLAP = 30
+    K1 = 1.2
+    B = 0.75
+    DENSE_WEIGHT = 0.5
+    EMBED_BATCH = 64
+    STOPWORDS = frozenset(
+        "a an and are as at be but by for from has have i in is it its me my of on or so that the this to "
+        "was we were what when which who will with you your".split()
+    )
+
+    def __init__(self, index_dir, embed=None):
+        # embed(texts) returns L2-normalized float32 rows; without it retrieval is BM25 only
+        self.index_dir = index_dir
+        self.embed = embed
+        self.index_path = os.path.join(index_dir, "index.json")
+        self.vectors_path = os.path.join(index_dir, "vectors.npy")
+        self.postings_path = os.path.join(index_dir, "postings.npz")
+        self.lock = threading.RLock()
+        self.pending_lock = threading.Lock()
+        self.loaded = False
+        self.pending_chats = {}
+        self.reset()
+
+    def reset(self):
+        self.chunks = []
+        self.lengths = array('H')
+        self.alive = bytearray()
+        self.live = 0
+        self.total_length = 0
+        self.sources = {}
+        self.postings = {}
+        self.term_arrays = {}
+        self.doc_arrays = None
+        self.vectors = None
+        self.dirty = False
+
+    @classmethod
+    def tokenize(cls, text):
+        return [term for term in re.findall(r"[a-z0-9]+", text.lower()) if term not in cls.STOPWORDS]
+
+    @classmethod
+    def split_chunks(cls, text):
+        words = text.split()
+        step = cls.CHUNK_WORDS - cls.CHUNK_OVERLAP
+        return [" ".join(words[start:start + cls.CHUNK_WORDS]) for start in range(0, max(1, len(words) - cls.CHUNK_OVERLAP), step)
+                if words[start:start + cls.CHUNK_WORDS]]
+
+    def ensure_loaded(self):
+        with self.lock:
+            if self.loaded:
+                return
+            self.loaded = True
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                for source, signature in data["sources"].items():
+                    self.sources[source] = {"signature": signature, "chunks": []}
+                if not self.load_postings(data):
+                    # No matching postings file (e.g. a crash between the two writes): re-tokenize the chunks
+                    self.reset()
+                    for source, signature in data["sources"].items():
+                        self.sources[source] = {"signature": signature, "chunks": []}
+                    for source, text in data["chunks"]:
+                        self.add_chunk(source, text)
+            except (OSError, json.JSONDecodeError, KeyError, TypeError, ValueError):
+                self.reset()
+                return
+            if self.embed and os.path.exists(self.vectors_path):
+                try:
+                    vectors = np.load(self.vectors_path)
+                    if vectors.shape[0] == len(self.chunks):
+                        self.vectors = vectors
+                except (OSError, ValueError):
+                    self.vectors = None
+            self.dirty = False
+
+    def load_postings(self, data):
+        # Postings are stored CSR-style (per-term counts over flat id/tf arrays), so a cold load is a
+        # few array copies instead of tokenizing every chunk again
+        try:
+            with np.load(self.postings_path) as stored:
+                if str(stored["stamp"]) != data["stamp"]:
+                    return False
+                ids, tfs, counts, lengths = stored["ids"], stored["tfs"], stored["counts"], stored["lengths"]
+        except (OSError, KeyError, ValueError):
+            return False
+        if lengths.shape[0] != len(data["chunks"]) or counts.shape[0] != len(data["terms"]):
+            return False
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        for i, term in enumerate(data["terms"]):
+            self.postings[term] = (array('I', ids[offsets[i]:offsets[i + 1]].tobytes()),
+                                   array('H', tfs[offsets[i]:offsets[i + 1]].tobytes()))
+        for chunk_id, (source, text) in enumerate(data["chunks"]):
+            self.chunks.append((source, text))
+            self.sources[source]["chunks"].append(chunk_id)
+        self.lengths = array('H', lengths.tobytes())
+        self.alive = bytearray(b"\x01" * len(self.chunks))
+        self.live = len(self.chunks)
+        self.total_length = int(lengths.sum())
+        return True
+
+    def add_chunk(self, source, text):
+        chunk_id = len(self.chunks)
+        terms = self.tokenize(text)
+        postings = self.postings
+        for term, tf in Counter(terms).items():
+            entry = postings.get(term)
+            if entry is None:
+                entry = postings[term] = (array('I'), array('H'))
+            entry[0].append(chunk_id)
+            entry[1].append(min(tf, 65535))
+        if self.term_arrays:
+            self.term_arrays.clear()
+        self.chunks.append((source, text))
+        self.lengths.append(min(len(terms), 65535))
+        self.alive.append(1)
+        self.live += 1
+        self.total_length += len(terms)
+        self.sources[source]["chunks"].append(chunk_id)
+        self.doc_arrays = None
+        self.dirty = True
+
+    def remove_source(self, source):
+        entry = self.sources.pop(source, None)
+        if entry is None:
+            return
+        for chunk_id in entry["chunks"]:
+            self.alive[chunk_id] = 0
+            self.live -= 1
+            self.total_length -= self.lengths[chunk_id]
+        self.doc_arrays = None
+        self.dirty = True
+
+    def add_document(self, source, text, signature):
+        with self.lock:
+            self.ensure_loaded()
+            self.remove_source(source)
+            self.sources[source] = {"signature": signature, "chunks": []}
+            for chunk in self.split_chunks(text):
+                self.add_chunk(source, chunk)
+
+    def is_current(self, source, signature):
+        with self.lock:
+            self.ensure_loaded()
+            entry = self.sources.get(source)
+            return entry is not None and entry["signature"] == signature
+
+    def note_chat(self, chat_id, start, messages):
+        # Called on the Tk thread, so it only takes the small lock; messages are chunked later on the worker
+        with self.pending_lock:
+            self.pending_chats.setdefault(chat_id, []).append((start, list(messages)))
+
+    def chat_counts(self):
+        with self.lock:
+            self.apply_pending_chats()
+            return {source[len("chat "):]: entry["signature"] for source, entry in self.sources.items() if source.startswith("chat ")}
+
+    def apply_pending_chats(self):
+        with self.lock:
+            self.ensure_loaded()
+            with self.pending_lock:
+                pending, self.pending_chats = self.pending_chats, {}
+            for chat_id, segments in pending.items():
+                source = f"chat {chat_id}"
+                entry = self.sources.setdefault(source, {"signature": 0, "chunks": []})
+                # The signature is how many messages are indexed; a segment that leaves a gap waits for the startup sync
+                for start, messages in segments:
+                    if start > entry["signature"]:
+                        continue
+                    for msg in messages[entry["signature"] - start:]:
+                        for chunk in self.split_chunks(msg["content"]):
+                            self.add_chunk(source, f"{msg['role']}: {chunk}")
+                    entry["signature"] = max(entry["signature"], start + len(messages))
+
+    def sync_attachments(self, directory, on_status=None):
+        names = sorted(name for name in os.listdir(directory) if os.path.isfile(os.path.join(directory, name))) if os.path.isdir(directory) else []
+        with self.lock:
+            self.ensure_loaded()
+            sources = {f"attachment {name}" for name in names}
+            for source in [s for s in self.sources if s.startswith("attachment ") and s not in sources]:
+                self.remove_source(source)
+        for name in names:
+            path = os.path.join(directory, name)
+            stat = os.stat(path)
+            signature = [stat.st_size, int(stat.st_mtime)]
+            if self.is_current(f"attachment {name}", signature):
+                continue
+            # Extraction runs outside the lock so searches are not held up by a long PDF
+            try:
+                text = read_attachment_text(path, on_status)
+            except Exception:
+                text = None
+            if text:
+                self.add_document(f"attachment {name}", text, signature)
+
+    def add_attachment(self, path, text):
+        stat = os.stat(path)
+        self.add_document(f"attachment {os.path.basename(path)}", text, [stat.st_size, int(stat.st_mtime)])
+
+    def postings_for(self, term):
+        arrays = self.term_arrays.get(term)
+        if arrays is None and term in self.postings:
+            ids, tfs = self.postings[term]
+            arrays = self.term_arrays[term] = (np.array(ids, dtype=np.int64), np.array(tfs, dtype=np.float32))
+        return arrays
+
+    def embed_pending(self):
+        done = 0 if self.vectors is None else self.vectors.shape[0]
+        if done >= len(self.chunks):
+            return
+        blocks = [] if self.vectors is None else [self.vectors]
+        for start in range(done, len(self.chunks), self.EMBED_BATCH):
+            blocks.append(np.asarray(self.embed([text for _, text in self.chunks[start:start + self.EMBED_BATCH]]), dtype=np.float32))
+        self.vectors = np.concatenate(blocks)
+        self.dirty = True
+
+    def search(self, query, k=4):
+        with self.lock:
+            self.apply_pending_chats()
+            if not self.live:
+                return []
+            if self.doc_arrays is None:
+                lengths = np.array(self.lengths, dtype=np.float32)
+                average = max(1.0, self.total_length / self.live)
+                self.doc_arrays = (self.K1 * (1 - self.B + self.B * lengths / average),
+                                   np.frombuffer(bytes(self.alive), dtype=np.uint8).astype(bool))
+            norms, alive = self.doc_arrays
+            scores = np.zeros(len(self.chunks), dtype=np.float32)
+            for term in set(self.tokenize(query)):
+                arrays = self.postings_for(term)
+                if arrays is None:
+                    continue
+                ids, tfs = arrays
+                idf = np.log(1 + (self.live - len(ids) + 0.5) / (len(ids) + 0.5))
+                scores[ids] += max(idf, 0.01) * tfs * (self.K1 + 1) / (tfs + norms[ids])
+            if self.embed:
+                self.embed_pending()
+                top = scores.max()
+                if top > 0:
+                    scores /= top
+                query_vector = np.asarray(self.embed([query]), dtype=np.float32)[0]
+                scores += self.DENSE_WEIGHT * np.maximum(self.vectors @ query_vector, 0)
+            scores[~alive] = 0
+            k = min(k, len(scores))
+            top_ids = np.argpartition(-scores, k - 1)[:k]
+            top_ids = top_ids[np.argsort(-scores[top_ids])]
+            return [{"source": self.chunks[i][0], "text": self.chunks[i][1], "score": float(scores[i])}
+                    for i in top_ids if scores[i] > 0]
+
+    def save(self):
+        with self.lock:
+            if not self.loaded:
+                return
+            self.apply_pending_chats()
+            if not self.dirty:
+                return
+            # Saving compacts: only live chunks are written, and ids are renumbered on the next load
+            alive = np.frombuffer(bytes(self.alive), dtype=np.uint8).astype(bool)
+            remap = np.cumsum(alive) - 1
+            terms, id_blocks, tf_blocks, counts = [], [], [], []
+            for term, (ids, tfs) in self.postings.items():
+                ids = np.array(ids, dtype=np.uint32)
+                keep = alive[ids]
+                if keep.any():
+                    terms.append(term)
+                    id_blocks.append(remap[ids[keep]].astype(np.uint32))
+                    tf_blocks.append(np.array(tfs, dtype=np.uint16)[keep])
+                    counts.append(int(keep.sum()))
+            keep = np.flatnonzero(alive)
+            stamp = uuid.uuid4().hex
+            data = json.dumps({"stamp": stamp, "sources": {source: entry["signature"] for source, entry in self.sources.items()},
+                               "terms": terms, "chunks": [self.chunks[i] for i in keep]})
+            postings = {
+                "stamp": np.array(stamp),
+                "ids": np.concatenate(id_blocks) if id_blocks else np.zeros(0, dtype=np.uint32),
+                "tfs": np.concatenate(tf_blocks) if tf_blocks else np.zeros(0, dtype=np.uint16),
+                "counts": np.array(counts, dtype=np.int64),
+                "lengths": np.array(self.lengths, dtype=np.uint16)[keep]
+            }
+            vectors = self.vectors[keep] if self.vectors is not None and self.vectors.shape[0] == len(self.chunks) else None
+            self.dirty = False
+        os.makedirs(self.index_dir, exist_ok=True)
+        with open(self.postings_path + ".tmp", 'wb') as f:
+            np.savez(f, **postings)
+        os.replace(self.postings_path + ".tmp", self.postings_path)
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.index_path)
+        if vectors is not None:
+            with open(self.vectors_path + ".tmp", 'wb') as f:
+                np.save(f, vectors)
+            os.replace(self.vectors_path + ".tmp", self.vectors_path)
+        elif os.path.exists(self.vectors_path):
+            os.remove(self.vectors_path)
+
+    def clear(self):
+        with self.lock:
+            shutil.rmtree(self.index_dir, ignore_errors=True)
+            self.reset()
+            with self.pending_lock:
+                self.pending_chats = {}
+            self.loaded = True
+
+def image_search_query(text):
+    # "find the beach pictures" / "show me photos of dogs" -> "beach" / "dogs"; None for anything else
+    text = text.strip().rstrip("?.!")
+    match = re.match(r"(?i)^(?:find|show|search(?: for)?)\s+(?:me\s+)?(?:the\s+|my\s+|all\s+)?(?:(?:pictures?|photos?|images?|pics)\s+(?:of|with)\s+(.+)|(.+?)\s+(?:pictures?|photos?|images?|pics))$", text)
+    if not match:
+        return None
+    return (match.group(1) or match.group(2)).strip()
+
+class ImageEmbeddingStore:
+    # CLIP image embeddings keyed by content hash, kept in a memory-mapped float16 matrix, so each image
+    # is encoded once however often it is attached, and text-to-image search is one matrix multiply
+    GROW_ROWS = 1024
+    ENCODE_BATCH = 16
+    MIN_SCORE = 0.2
+    QUERY_TEMPLATES = ("{}", "a photo of {}", "a picture of {}", "an image showing {}")
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.index_path = os.path.join(index_dir, "index.json")
+        self.matrix_path = os.path.join(index_dir, "embeddings.f16")
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.reset()
+
+    def ensure_loaded(self):
+        # Opening the memmap imports numpy, so it happens on the first worker job rather than at startup
+        with self.lock:
+            if self.loaded:
+                return
+            self.loaded = True
+            try:
+                with open(self.index_path, 'r') as f:
+                    data = json.load(f)
+                self.dim = data["dim"]
+                self.count = data["count"]
+                self.hashes = data["hashes"]
+                self.files = data["files"]
+                self.open_matrix()
+            except (OSError, json.JSONDecodeError, KeyError, TypeError, ValueError):
+                self.reset()
+
+    def reset(self):
+        self.dim = None
+        self.count = 0
+        self.hashes = {}  # content hash -> {"row": int, "description": str or None}
+        self.files = {}  # path -> {"signature": [size, mtime_ns], "hash": str}
+        self.matrix = None
+
+    def open_matrix(self, capacity=None):
+        if capacity is not None:
+            if self.matrix is not None:
+                self.matrix.flush()
+                self.matrix = None
+            os.makedirs(self.index_dir, exist_ok=True)
+            with open(self.matrix_path, 'ab') as f:
+                f.truncate(capacity * self.dim * 2)
+        rows = os.path.getsize(self.matrix_path) // (self.dim * 2)
+        if rows < self.count:
+            raise ValueError("embedding matrix is shorter than its index")
+        self.matrix = np.memmap(self.matrix_path, dtype=np.float16, mode='r+', shape=(rows, self.dim))
+
+    @staticmethod
+    def file_hash(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def hash_for(self, path):
+        # Unchanged files are recognised by size and mtime, so only new or edited files are read
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        entry = self.files.get(path)
+        if entry is None or entry["signature"] != signature:
+            entry = self.files[path] = {"signature": signature, "hash": self.file_hash(path)}
+        return entry["hash"]
+
+    def ensure(self, paths, encode, on_status=None):
+        # encode(paths) returns L2-normalized float32 rows; only content not seen before is encoded
+        with self.lock:
+            self.ensure_loaded()
+            hashes = [self.hash_for(path) for path in paths]
+            missing = OrderedDict()
+            for path, content_hash in zip(paths, hashes):
+                if content_hash not in self.hashes:
+                    missing.setdefault(content_hash, path)
+            if missing:
+                tracker = ProgressTracker("Indexing images", len(missing), on_status, "images") if on_status and len(missing) > 1 else None
+                items = list(missing.items())
+                for start in range(0, len(items), self.ENCODE_BATCH):
+                    batch = items[start:start + self.ENCODE_BATCH]
+                    vectors = np.asarray(encode([path for _, path in batch]), dtype=np.float32)
+                    if self.dim is None:
+                        self.dim = vectors.shape[1]
+                    if self.matrix is None or self.count + len(batch) > self.matrix.shape[0]:
+                        self.open_matrix(self.count + len(batch) + self.GROW_ROWS)
+                    self.matrix[self.count:self.count + len(batch)] = vectors.astype(np.float16)
+                    for content_hash, _ in batch:
+                        self.hashes[content_hash] = {"row": self.count, "description": None}
+                        self.count += 1
+                    if tracker:
+                        tracker.advance(len(batch))
+                self.matrix.flush()
+            self.save()
+            return hashes
+
+    def vector(self, content_hash):
+        with self.lock:
+            return np.asarray(self.matrix[self.hashes[content_hash]["row"]], dtype=np.float32)
+
+    def description(self, content_hash):
+        with self.lock:
+            return self.hashes[content_hash]["description"]
+
+    def set_description(self, content_hash, description):
+        with self.lock:
+            self.hashes[content_hash]["description"] = description
+            self.save()
+
+    def sync(self, directories, encode, on_status=None):
+        paths = [os.path.join(directory, name) for directory in directories if os.path.isdir(directory)
+                 for name in sorted(os.listdir(directory)) if name.lower().endswith((".png", ".jpg", ".jpeg"))]
+        current = set(paths)
+        with self.lock:
+            self.ensure_loaded()
+            for path in [p for p in self.files if p not in current]:
+                del self.files[path]
+            self.ensure(paths, encode, on_status)
+
+    def search(self, query, encode_text, k=6):
+        # The query is encoded under a few templates in one batch and averaged (prompt ensembling)
+        text = np.asarray(encode_text([template.format(query) for template in self.QUERY_TEMPLATES]), dtype=np.float32).mean(axis=0)
+        text /= max(float(np.linalg.norm(text)), 1e-6)
+        with self.lock:
+            self.ensure_loaded()
+            if not self.count:
+                return []
+            paths_by_row = {}
+            for path, entry in self.files.items():
+                paths_by_row.setdefault(self.hashes[entry["hash"]]["row"], path)
+            scores = np.asarray(self.matrix[:self.count], dtype=np.float32) @ text
+            rows = np.argsort(-scores)
+            results = []
+            for row in rows:
+                if scores[row] < self.MIN_SCORE or len(results) >= k:
+                    break
+                if row in paths_by_row:
+                    results.append((paths_by_row[row], float(scores[row])))
+            return results
+
+    def save(self):
+        with self.lock:
+            os.makedirs(self.index_dir, exist_ok=True)
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({"dim": self.dim, "count": self.count, "hashes": self.hashes, "files": self.files}, f)
+            os.replace(tmp_path, self.index_path)
+
+    def clear(self):
+        with self.lock:
+            self.matrix = None
+            shutil.rmtree(self.index_dir, ignore_errors=True)
+            self.reset()
+            self.loaded = True
+
+class ChatStore:
+    # Chats live in SQLite (WAL): a new message is one INSERT instead of re-serializing the whole history,
+    # every write is an atomic transaction, and a writer thread batches them off the Tk thread.
+    # Startup reads only the chats table (id, title, timestamp, message count); message bodies are
+    # read when a chat is opened and kept in a small LRU.
+    TITLE_CHARS = 40
+
+    def __init__(self, path=CHAT_DB_FILE, legacy_path=CHAT_HISTORY_FILE, on_status=None, cache_chats=16):
+        self.path = path
+        self.on_status = on_status
+        self.cache_chats = max(1, cache_chats)
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS chats (chat_id TEXT PRIMARY KEY, timestamp TEXT, title TEXT DEFAULT '', "
+                        "message_count INTEGER DEFAULT 0)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS messages (chat_id TEXT, msg_index INTEGER, role TEXT, content TEXT, "
+                        "PRIMARY KEY (chat_id, msg_index)) WITHOUT ROWID")
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(chats)")}
+        if "message_count" not in columns:
+            # Databases written before the chat index existed
+            self.db.execute("ALTER TABLE chats ADD COLUMN title TEXT DEFAULT ''")
+            self.db.execute("ALTER TABLE chats ADD COLUMN message_count INTEGER DEFAULT 0")
+            self.backfill_index()
+        self.db.commit()
+        self.migrate(legacy_path)
+        self.index = OrderedDict(
+            (chat_id, {"timestamp": timestamp, "title": title or "", "count": count or 0})
+            for chat_id, timestamp, title, count in self.db.execute("SELECT chat_id, timestamp, title, message_count FROM chats ORDER BY rowid")
+        )
+        self.writer = threading.Thread(target=self.run, daemon=True)
+        self.writer.start()
+
+    def backfill_index(self):
+        self.db.execute(
+            "UPDATE chats SET message_count = (SELECT COUNT(*) FROM messages m WHERE m.chat_id = chats.chat_id), "
+            f"title = coalesce((SELECT substr(content, 1, {self.TITLE_CHARS}) FROM messages m "
+            "WHERE m.chat_id = chats.chat_id AND role = 'User' ORDER BY msg_index LIMIT 1), '')"
+        )
+
+    def migrate(self, legacy_path):
+        # One-time import of chat_history.json; the file is kept, renamed, as a backup
+        if not os.path.exists(legacy_path) or self.db.execute("SELECT 1 FROM chats LIMIT 1").fetchone():
+            return
+        try:
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                chats = json.load(f)["chats"]
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO chats (chat_id, timestamp) VALUES (?, ?)",
+                                    [(chat_id, chat["timestamp"]) for chat_id, chat in chats.items()])
+                self.db.executemany("INSERT OR REPLACE INTO messages (chat_id, msg_index, role, content) VALUES (?, ?, ?, ?)",
+                                    [(chat_id, i, msg["role"], msg["content"])
+                                     for chat_id, chat in chats.items() for i, msg in enumerate(chat["messages"])])
+                self.backfill_index()
+        except (OSError, json.JSONDecodeError, KeyError, TypeError, AttributeError):
+            # Unreadable or not in the {"chats": ...} format; start empty as initialize_chat_history used to
+            return
+        os.replace(legacy_path, os.path.splitext(legacy_path)[0] + ".migrated.json")
+
+    def read_messages(self, chat_id, start=0):
+        # Straight from the database, bypassing the LRU; queued writes are committed first
+        self.flush()
+        with self.lock:
+            rows = self.db.execute("SELECT role, content FROM messages WHERE chat_id = ? AND msg_index >= ? ORDER BY msg_index",
+                                   (chat_id, start)).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def messages(self, chat_id):
+        with self.lock:
+            if chat_id in self.cache:
+                self.cache.move_to_end(chat_id)
+                return self.cache[chat_id]
+        for attempt in range(3):
+            messages = self.read_messages(chat_id)
+            with self.lock:
+                # Another thread may have loaded it, or appended to it after the read, meanwhile.
+                # A write that failed never shows up, so the last attempt takes what is on disk.
+                if chat_id not in self.cache:
+                    entry = self.index.get(chat_id)
+                    if entry is not None and len(messages) < entry["count"] and attempt < 2:
+                        continue
+                    self.cache[chat_id] = messages
+                self.cache.move_to_end(chat_id)
+                while len(self.cache) > self.cache_chats:
+                    self.cache.popitem(last=False)
+                return self.cache[chat_id]
+
+    def create_chat(self, chat_id, timestamp):
+        with self.lock:
+            self.index[chat_id] = {"timestamp": timestamp, "title": "", "count": 0}
+            self.cache[chat_id] = []
+            while len(self.cache) > self.cache_chats:
+                self.cache.popitem(last=False)
+        self.queue.put(("INSERT OR REPLACE INTO chats (chat_id, timestamp) VALUES (?, ?)", [(chat_id, timestamp)]))
+
+    def append(self, chat_id, messages):
+        # Returns the index of the first appended message
+        with self.lock:
+            entry = self.index[chat_id]
+            start = entry["count"]
+            entry["count"] += len(messages)
+            if not entry["title"]:
+                entry["title"] = next((msg["content"][:self.TITLE_CHARS] for msg in messages if msg["role"] == "User"), "")
+            if chat_id in self.cache:
+                self.cache[chat_id].extend(messages)
+            title, count = entry["title"], entry["count"]
+        self.queue.put(("INSERT OR REPLACE INTO messages (chat_id, msg_index, role, content) VALUES (?, ?, ?, ?)",
+                        [(chat_id, i, msg["role"], msg["content"]) for i, msg in enumerate(messages, start)]))
+        self.queue.put(("UPDATE chats SET title = ?, message_count = ? WHERE chat_id = ?", [(title, count, chat_id)]))
+        return start
+
+    def clear(self):
+        with self.lock:
+            self.index.clear()
+            self.cache.clear()
+        self.queue.put(("DELETE FROM messages", [()]))
+        self.queue.put(("DELETE FROM chats", [()]))
+
+    def flush(self):
+        self.queue.join()
+
+    def run(self):
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA synchronous=NORMAL")
+        while True:
+            # Whatever queued up while the last transaction was committing goes into the next one
+            ops = [self.queue.get()]
+            while True:
+                try:
+                    ops.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with db:
+                    for sql, rows in ops:
+                        db.executemany(sql, rows)
+            except sqlite3.Error as e:
+                if self.on_status:
+                    self.on_status(f"Error saving chats: {str(e)}", 0)
+            finally:
+                for _ in ops:
+                    self.queue.task_done()
+
+class ChatSearchIndex:
+    # SQLite FTS5 index over every chat message, ranked with bm25. Messages are added as they are saved,
+    # so a search never loads or scans the chat history. Like ChatStore, writes are queued for a writer
+    # thread that commits whatever has queued up in one transaction; reads wait for queued writes first.
+    def __init__(self, path=CHAT_SEARCH_DB, on_status=None):
+        self.path = path
+        self.on_status = on_status
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5("
+                        "content, role UNINDEXED, chat_id UNINDEXED, msg_index UNINDEXED, tokenize='unicode61 remove_diacritics 2')")
+        self.db.execute("CREATE TABLE IF NOT EXISTS indexed (chat_id TEXT PRIMARY KEY, count INTEGER)")
+        self.db.commit()
+        self.writer = threading.Thread(target=self.run, daemon=True)
+        self.writer.start()
+
+    @staticmethod
+    def match_expression(query):
+        # "quoted text" matches as an exact phrase; every other word matches as a prefix (recip -> recipe)
+        parts = []
+        for phrase, word in re.findall(r'"([^"]+)"|(\S+)', query):
+            terms = re.findall(r"\w+", phrase or word)
+            if phrase and terms:
+                parts.append('"' + " ".join(terms) + '"')
+            else:
+                parts.extend(f'"{term}"*' for term in terms)
+        return " ".join(parts)
+
+    def counts(self):
+        self.flush()
+        with self.lock:
+            return dict(self.db.execute("SELECT chat_id, count FROM indexed"))
+
+    def append(self, chat_id, start, messages):
+        self.queue.put((self.write_append, (chat_id, start, list(messages))))
+
+    def write_append(self, chat_id, start, messages):
+        # Messages are only ever appended; anything already indexed is skipped, and a segment that
+        # would leave a gap is left for the startup sync
+        row = self.db.execute("SELECT count FROM indexed WHERE chat_id = ?", (chat_id,)).fetchone()
+        indexed = row[0] if row else 0
+        if start > indexed or start + len(messages) <= indexed:
+            return
+        self.db.executemany("INSERT INTO messages (content, role, chat_id, msg_index) VALUES (?, ?, ?, ?)",
+                            [(msg["content"], msg["role"], chat_id, i) for i, msg in enumerate(messages[indexed - start:], indexed)])
+        self.db.execute("INSERT OR REPLACE INTO indexed (chat_id, count) VALUES (?, ?)", (chat_id, start + len(messages)))
+
+    def remove(self, chat_id):
+        self.queue.put((self.write_remove, (chat_id,)))
+
+    def write_remove(self, chat_id):
+        self.db.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+        self.db.execute("DELETE FROM indexed WHERE chat_id = ?", (chat_id,))
+
+    def search(self, query, limit=50):
+        expression = self.match_expression(query)
+        if not expression:
+            return []
+        self.flush()
+        with self.lock:
+            return self.db.execute(
+                "SELECT chat_id, msg_index, role, snippet(messages, 0, '[', ']', '...', 12) FROM messages "
+                "WHERE messages MATCH ? ORDER BY rank LIMIT ?", (expression, limit)
+            ).fetchall()
+
+    def clear(self):
+        self.queue.put((self.write_clear, ()))
+
+    def write_clear(self):
+        self.db.execute("DELETE FROM messages")
+        self.db.execute("DELETE FROM indexed")
+
+    def flush(self):
+        self.queue.join()
+
+    def run(self):
+        while True:
+            ops = [self.queue.get()]
+            while True:
+                try:
+                    ops.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self.lock, self.db:
+                    for write, args in ops:
+                        write(*args)
+            except sqlite3.Error as e:
+                if self.on_status:
+                    self.on_status(f"Error indexing chats: {str(e)}", 0)
+            finally:
+                for _ in ops:
+                    self.queue.task_done()
+
+class TranscriptView:
+    # Windowed rendering of a saved chat in its ScrolledText. Only a page of messages is inserted when a
+    # chat is opened; placeholder lines at either end page more in (one page per frame) when they scroll
+    # into view, and the far end is trimmed so at most MAX_RENDERED saved messages are ever in the widget.
+    # Messages and images shown live go after the saved ones and are not windowed.
+    PAGE_MESSAGES = 40
+    MAX_RENDERED = 200
+    MAX_IMAGES = 24
+
+    def __init__(self, widget):
+        self.widget = widget
+        self.fetch = None
+        self.count = 0
+        self.first = 0
+        self.last = 0
+        self.pending = None
+        self.images = []
+        widget.configure(yscrollcommand=self.on_yscroll)
+        widget.tag_config("placeholder", foreground="gray")
+
+    def load(self, fetch, count):
+        # fetch(start, end) returns saved messages [start, end); count is how many there are
+        self.fetch = fetch
+        self.count = count
+        self.show(max(0, count - self.PAGE_MESSAGES))
+        self.widget.yview(tk.END)
+
+    def show(self, start):
+        # Replaces the rendered saved messages with the page starting at start
+        widget = self.widget
+        widget.config(state='normal')
+        self.remove_placeholders()
+        if widget.tag_ranges("history"):
+            widget.delete("history.first", "history.last")
+        for i in range(self.first, self.last):
+            widget.mark_unset(f"msg_{i}")
+        self.first = self.last = start
+        self.insert_newer(min(start + self.PAGE_MESSAGES, self.count))
+        self.add_placeholders()
+        widget.config(state='disabled')
+
+    @staticmethod
+    def message_text(msg):
+        return f"{msg['role']}: {msg['content']}\n\n"
+
+    def insert_older(self, start):
+        # Inserted newest first at the top; msg_ marks keep right gravity so later inserts push them down
+        messages = self.fetch(start, self.first)
+        for i in range(len(messages) - 1, -1, -1):
+            self.widget.insert("1.0", self.message_text(messages[i]), "history")
+            self.widget.mark_set(f"msg_{start + i}", "1.0")
+        self.first = start
+
+    def insert_newer(self, end):
+        for i, msg in enumerate(self.fetch(self.last, end), self.last):
+            pos = self.widget.index("history.last") if self.widget.tag_ranges("history") else "1.0"
+            self.widget.insert(pos, self.message_text(msg), "history")
+            self.widget.mark_set(f"msg_{i}", pos)
+        self.last = end
+
+    def trim_newer(self, end):
+        self.widget.delete(f"msg_{end}", "history.last")
+        for i in range(end, self.last):
+            self.widget.mark_unset(f"msg_{i}")
+        self.last = end
+
+    def trim_older(self, start):
+        self.widget.delete("1.0", f"msg_{start}")
+        for i in range(self.first, start):
+            self.widget.mark_unset(f"msg_{i}")
+        self.first = start
+
+    def remove_placeholders(self):
+        for tag in ("older", "newer"):
+            if self.widget.tag_ranges(tag):
+                self.widget.delete(f"{tag}.first", f"{tag}.last")
+
+    def add_placeholders(self):
+        if self.first > 0:
+            self.widget.insert("1.0", f"... {self.first} earlier messages (scroll up to load)\n\n", ("history", "older", "placeholder"))
+        if self.last < self.count:
+            self.widget.insert(self.widget.index("history.last"), f"... {self.count - self.last} later messages (scroll down to load)\n\n",
+                               ("history", "newer", "placeholder"))
+
+    def on_yscroll(self, first, last):
+        self.widget.vbar.set(first, last)
+        if self.pending is None and self.fetch is not None:
+            self.pending = self.widget.after(16, self.check_page)
+
+    def check_page(self):
+        self.pending = None
+        widget = self.widget
+        if not widget.winfo_exists():
+            return
+        if self.first > 0 and widget.tag_ranges("older") and widget.bbox("older.first"):
+            self.page(older=True)
+        elif self.last < self.count and widget.tag_ranges("newer") and widget.bbox("newer.first"):
+            self.page(older=False)
+
+    def page(self, older):
+        widget = self.widget
+        widget.config(state='normal')
+        # Whatever is at the top of the view stays there: right gravity rides along with text inserted
+        # above it, left gravity stays put when text is inserted below it
+        widget.mark_set("view_anchor", "@0,0")
+        widget.mark_gravity("view_anchor", tk.RIGHT if older else tk.LEFT)
+        self.remove_placeholders()
+        if older:
+            self.insert_older(max(0, self.first - self.PAGE_MESSAGES))
+            if self.last - self.first > self.MAX_RENDERED:
+                self.trim_newer(self.first + self.MAX_RENDERED)
+        else:
+            self.insert_newer(min(self.count, self.last + self.PAGE_MESSAGES))
+            if self.last - self.first > self.MAX_RENDERED:
+                self.trim_older(self.last - self.MAX_RENDERED)
+        self.add_placeholders()
+        widget.config(state='disabled')
+        widget.yview("view_anchor")
+        widget.mark_unset("view_anchor")
+
+    def add_image(self, photo, label):
+        # Tk only holds a weak reference, so shown PhotoImages stay alive here; past MAX_IMAGES the oldest
+        # is swapped for its file name and released
+        name = self.widget.image_create(tk.END, image=photo)
+        self.images.append((name, label, photo))
+        while len(self.images) > self.MAX_IMAGES:
+            old_name, old_label, _ = self.images.pop(0)
+            index = self.widget.index(old_name)
+            self.widget.delete(index)
+            self.widget.insert(index, f"[{old_label}]")
+
+class ModelRegistry:
+    # Installed model snapshots (path + hub revision) so loads resolve to local folders and never
+    # probe the network; install_tinyllama.py records its downloads through this class too
+    def __init__(self, path=MODEL_REGISTRY_FILE, offline=False):
+        self.path = path
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.models = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self.models = json.load(f).get("models", {})
+            except (json.JSONDecodeError, IOError):
+                self.models = {}
+
+    def entry(self, name):
+        entry = self.models.get(name)
+        if entry and os.path.isdir(entry["path"]):
+            return entry
+        return None
+
+    def resolve(self, name):
+        entry = self.entry(name)
+        if entry:
+            return entry["path"]
+        repo_id, patterns = MODEL_SOURCES[name]
+        # Not registered yet: adopt a snapshot already in the Hugging Face cache, otherwise download once
+        from huggingface_hub import snapshot_download
+        try:
+            path = snapshot_download(repo_id, allow_patterns=patterns, local_files_only=True)
+        except Exception:
+            if self.offline:
+                raise RuntimeError(f"{repo_id} is not installed. Run install_tinyllama.py --all on a machine with internet access.")
+            path = snapshot_download(repo_id, allow_patterns=patterns)
+        self.record(name, repo_id, path)
+        return path
+
+    def record(self, name, repo_id, path):
+        size = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+        with self.lock:
+            self.models[name] = {
+                "repo_id": repo_id,
+                # Hub snapshots live in snapshots/<commit>, which pins the exact weights
+                "revision": os.path.basename(os.path.normpath(path)),
+                "path": path,
+                "size_mb": round(size / (1024 * 1024)),
+                "installed": datetime.datetime.now().isoformat(timespec="seconds")
+            }
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({"models": self.models}, f, indent=4)
+            os.replace(tmp_path, self.path)
+
+    def revision(self, name):
+        entry = self.entry(name)
+        return entry["revision"] if entry else None
+
+class ModelGovernor:
+    # Models load on first use and the least recently used ones are unloaded when the next load
+    # would go over the RAM budget; idle models (e.g. Stable Diffusion) are also dropped after a while.
+    # Callers must run on the scheduler worker so a model is never unloaded mid-inference.
+    # A model held by a job that other jobs can run inside of (image generation) is never picked for unloading.
+    def __init__(self, budget_mb, on_status=None):
+        self.budget_mb = budget_mb
+        self.on_status = on_status
+        self.specs = {}
+        self.resident = OrderedDict()
+        self.held = Counter()
+        self.stats = {}
+        self.lock = threading.RLock()
+
+    def register(self, name, label, load, unload, estimate_mb, idle_seconds=None):
+        # load() returns the torch modules it created so their size can be tracked
+        self.specs[name] = {"label": label, "load": load, "unload": unload, "estimate_mb": estimate_mb,
+                            "idle_seconds": idle_seconds}
+
+    def resident_mb(self):
+        return sum(entry["mb"] for entry in self.resident.values())
+
+    def is_loaded(self, name):
+        return name in self.resident
+
+    @contextlib.contextmanager
+    def hold(self, name):
+        with self.lock:
+            self.acquire(name)
+            self.held[name] += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.held[name] -= 1
+
+    def evictable(self):
+        return next((name for name in self.resident if not self.held[name]), None)
+
+    def acquire(self, name):
+        with self.lock:
+            if name in self.resident:
+                self.resident.move_to_end(name)
+                self.resident[name]["last_used"] = time.time()
+                return
+            spec = self.specs[name]
+            while self.evictable() and self.resident_mb() + spec["estimate_mb"] > self.budget_mb:
+                self.unload(self.evictable(), "RAM budget")
+            rss_before = get_rss_mb()
+            stats = self.stats.setdefault(name, {})
+            with measure_load(stats):
+                modules = spec["load"]()
+            # Quantized weights live outside parameters(), so take whichever measure is larger
+            mb = max(module_size_mb(*modules), stats["rss_mb"] - rss_before)
+            spec["estimate_mb"] = mb
+            stats["resident_mb"] = round(mb)
+            self.resident[name] = {"mb": mb, "last_used": time.time()}
+            if self.on_status:
+                self.on_status(f"{spec['label']} ready (loaded in {stats['load_seconds']}s, "
+                               f"peak RSS {stats['peak_rss_mb']} MB, resident ~{stats['resident_mb']} MB)", 100, 0)
+            # The estimate may have been low; settle the difference against the other models
+            while self.evictable() not in (None, name) and self.resident_mb() > self.budget_mb:
+                self.unload(self.evictable(), "RAM budget")
+
+    def unload(self, name, reason):
+        with self.lock:
+            entry = self.resident.pop(name, None)
+            if entry is None:
+                return
+            spec = self.specs[name]
+            spec["unload"]()
+            gc.collect()
+            if self.on_status:
+                self.on_status(f"Unloaded {spec['label']} ({reason}), freed ~{round(entry['mb'])} MB", 100, 0)
+
+    def unload_idle(self):
+        now = time.time()
+        with self.lock:
+            for name, entry in list(self.resident.items()):
+                idle_seconds = self.specs[name]["idle_seconds"]
+                if idle_seconds and not self.held[name] and now - entry["last_used"] > idle_seconds:
+                    self.unload(name, f"idle {round(idle_seconds / 60)} min")
+
+class JobCancelled(Exception):
+    pass
+
+class InferenceJob:
+    def __init__(self, priority, seq, kind, fn, tab_name=None, request=None):
+        self.priority = priority
+        self.seq = seq
+        self.kind = kind
+        self.fn = fn
+        self.tab_name = tab_name
+        self.future = Future()
+        self.cancel_event = threading.Event()
+        self.request = request
+        if request is not None:
+            request.job = self
+            request.future = self.future
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        # Queued jobs are dropped outright; running jobs poll cancel_event between tokens/steps
+        self.cancel_event.set()
+        self.future.cancel()
+
+class InferenceScheduler:
+    # One worker runs every model call so tabs never pile threads onto torch at the same time
+    PRIORITY_INTERACTIVE = 0
+    PRIORITY_ATTACHMENT = 1
+    PRIORITY_API = 1
+    PRIORITY_BACKGROUND = 2
+
+    def __init__(self, max_queue=8, num_threads=None, interop_threads=1):
+        self.queue = queue.PriorityQueue(maxsize=max_queue)
+        self.counter = itertools.count()
+        self.current_job = None
+        self.num_threads = num_threads or os.cpu_count() or 1
+        self.interop_threads = interop_threads
+        self.threads_changed = True
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def set_threads(self, num_threads, interop_threads=1):
+        self.num_threads = num_threads
+        self.interop_threads = interop_threads
+        self.threads_changed = True
+
+    def configure_torch(self):
+        # Done on the worker before its next job so importing torch never blocks the Tk thread
+        torch.set_num_threads(self.num_threads)
+        try:
+            torch.set_num_interop_threads(self.interop_threads)
+        except RuntimeError:
+            # Only settable before the first inter-op parallel work; applies from the next launch
+            pass
+
+    def submit(self, kind, fn, priority, tab_name=None, on_done=None, request=None):
+        job = InferenceJob(priority, next(self.counter), kind, fn, tab_name, request)
+        if on_done:
+            job.future.add_done_callback(on_done)
+        self.queue.put_nowait(job)
+        return job
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def take_pending(self, kind, limit, accept=None):
+        # Lets a running batch pull queued jobs of the same kind without waiting for its turn
+        taken = []
+        with self.queue.mutex:
+            keep = []
+            for job in self.queue.queue:
+                if job.kind == kind and job.request is not None and len(taken) < limit and (accept is None or accept(job.request)):
+                    taken.append(job)
+                else:
+                    keep.append(job)
+            if not taken:
+                return []
+            heapq.heapify(keep)
+            self.queue.queue[:] = keep
+            self.queue.not_full.notify(len(taken))
+        return [job for job in taken if not job.cancelled and job.future.set_running_or_notify_cancel()]
+
+    def pending_kind(self, kind):
+        with self.queue.mutex:
+            return sum(1 for job in self.queue.queue if job.kind == kind and not job.cancelled)
+
+    def run_waiting(self, priority, kind):
+        # Called by a long job between its steps: queued jobs more urgent than it run here, on the same
+        # worker, and the long job picks up where it left off once they are done. Jobs of its own kind
+        # stay queued, since re-entering the same pipeline would reset the state of the run in progress.
+        while True:
+            with self.queue.mutex:
+                waiting = [job for job in self.queue.queue if job.priority < priority and job.kind != kind]
+                if not waiting:
+                    return
+                job = min(waiting)
+                self.queue.queue.remove(job)
+                heapq.heapify(self.queue.queue)
+                self.queue.not_full.notify()
+            self.execute(job)
+
+    def execute(self, job):
+        if job.cancelled or not job.future.set_running_or_notify_cancel():
+            return
+        previous, self.current_job = self.current_job, job
+        try:
+            result = job.fn(job)
+            # Batched jobs may already have been resolved by the batch that served them
+            if not job.future.done():
+                job.future.set_result(result)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            self.current_job = previous
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if self.threads_changed:
+                self.threads_changed = False
+                self.configure_torch()
+            self.execute(job)
+
+class GenerationRequest:
+    def __init__(self, query, max_new_tokens, temperature=0.7, do_sample=True, on_token=None, chat_id=None, seed=None, cacheable=False,
+                 history=None, search_query=None):
+        self.query = query
+        self.history = history
+        self.search_query = search_query
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.do_sample = do_sample
+        self.on_token = on_token
+        self.chat_id = chat_id
+        self.seed = seed
+        self.cacheable = cacheable
+        # Created on the worker at prefill, so building a request never imports torch on the Tk thread
+        self.generator = None
+        self.cache_key = None
+        self.from_cache = False
+        self.job = None
+        self.future = None
+        self.input_ids = []
+        self.output_ids = []
+        self.length = 0
+        self.reused = 0
+        self.emitted = ""
+        self.start_time = None
+        self.first_token_time = None
+        self.finished = False
+        self.response = None
+        self.drafted = 0
+        self.accepted = 0
+
+    @property
+    def cancelled(self):
+        return self.job is not None and self.job.cancelled
+
+    @property
+    def exclusive(self):
+        # A seeded reply is only reproducible if nothing else shapes its forward passes: it runs unbatched,
+        # without speculation and with a full prefill instead of a reused KV cache
+        return self.seed is not None
+
+def left_pad_cache(tensor, length):
+    pad = length - tensor.shape[-2]
+    if pad <= 0:
+        return tensor
+    return torch.cat([tensor.new_zeros(tensor.shape[0], tensor.shape[1], pad, tensor.shape[3]), tensor], dim=2)
+
+def make_dynamic_cache(keys, values):
+    cache = transformers.DynamicCache()
+    cache.key_cache = list(keys)
+    cache.value_cache = list(values)
+    cache._seen_tokens = keys[0].shape[-2] if keys else 0
+    return cache
+
+class BatchGenerator:
+    # Continuous batching: chat requests from any tab join the running batch between decode steps
+    # and leave it as soon as they finish, so several tabs share one set of matmuls per token
+    LOOKUP_DRAFT_TOKENS = 8
+    MODEL_DRAFT_TOKENS = 4
+    LOOKUP_MAX_NGRAM = 3
+
+    def __init__(self, model, tokenizer, kv_cache, build_prompt, scheduler=None, max_batch=4, on_status=None, stats=None,
+                 response_cache=None, model_id=CHAT_MODEL_NAME, speculative=False, draft_model=None):
+        self.model = model
+        # model.generate() applied the checkpoint's top-k/top-p (transformers defaults to top_k=50) on top of temperature
+        config = getattr(model, "generation_config", None)
+        self.top_k = getattr(config, "top_k", None)
+        self.top_k = 50 if self.top_k is None else self.top_k
+        self.top_p = getattr(config, "top_p", None)
+        self.top_p = 1.0 if self.top_p is None else self.top_p
+        self.speculative = speculative
+        self.draft_model = draft_model
+        self.draft_cache = None
+        self.draft_ids = []
+        self.token_count = 0
+        self.tokenizer = tokenizer
+        self.response_cache = response_cache
+        self.model_id = model_id
+        self.kv_cache = kv_cache
+        self.build_prompt = build_prompt
+        self.scheduler = scheduler
+        self.max_batch = max(1, max_batch)
+        self.on_status = on_status
+        self.stats = stats if stats is not None else {}
+        self.rows = []
+        self.keys = []
+        self.values = []
+        self.mask = None
+
+    def run(self, request):
+        pending = [request]
+        start_count = self.token_count
+        start = time.time()
+        tracker = ProgressTracker("Generating", 0, self.on_status, "tokens") if self.on_status else None
+        try:
+            with torch.inference_mode():
+                while True:
+                    room = self.max_batch - len(self.rows) - len(pending)
+                    if room > 0 and self.scheduler and not any(req.exclusive for req in self.rows + pending):
+                        pending += [job.request for job in self.scheduler.take_pending("chat", room, lambda req: not req.exclusive)]
+                    for req in pending:
+                        row_cache = self.prefill(req)
+                        if row_cache is None:
+                            self.finish(req, None, None)
+                            continue
+                        if req.finished:
+                            self.finish(req, row_cache.key_cache, row_cache.value_cache)
+                        else:
+                            self.add_row(req, row_cache)
+                    pending = []
+                    if not self.rows:
+                        break
+                    # Speculation only pays off for a lone sequence; batched rows already share each forward pass
+                    if not (self.speculative and len(self.rows) == 1 and not self.rows[0].exclusive and self.speculative_step()):
+                        self.decode_step()
+                    if tracker:
+                        # max_new_tokens is an upper bound, so the ETA only shrinks if EOS comes early
+                        done = self.token_count - start_count
+                        tracker.update(done, done + sum(req.max_new_tokens - len(req.output_ids) for req in self.rows))
+                    self.drop_finished()
+        except Exception as e:
+            for req in self.rows + pending:
+                if req.future and not req.future.done():
+                    req.future.set_exception(e)
+            self.reset()
+            raise
+        elapsed = time.time() - start
+        self.stats["tokens_per_sec"] = round((self.token_count - start_count) / elapsed, 1) if elapsed > 0 else None
+        return request.response
+
+    def prefill(self, req):
+        req.start_time = time.time()
+        req.input_ids = self.build_prompt(req.chat_id, req.query, req.max_new_tokens, req.history, req.search_query)
+        if req.cacheable and self.response_cache:
+            sampling = {"do_sample": req.do_sample, "temperature": req.temperature, "seed": req.seed,
+                        "top_k": self.top_k, "top_p": self.top_p}
+            req.cache_key = ResponseCache.make_key(self.model_id, req.input_ids, req.max_new_tokens, sampling)
+            entry = self.response_cache.get(req.cache_key)
+            if entry is not None:
+                req.output_ids = entry["output_ids"]
+                req.from_cache = True
+                req.finished = True
+                req.first_token_time = time.time()
+                if req.on_token:
+                    req.on_token(entry["response"])
+                return None
+        if req.seed is not None:
+            req.generator = torch.Generator().manual_seed(req.seed)
+        row_cache, req.reused = self.kv_cache.take(req.chat_id, req.input_ids) if req.chat_id and not req.exclusive else (None, 0)
+        if row_cache is None:
+            row_cache = transformers.DynamicCache()
+        new_ids = torch.tensor([req.input_ids[req.reused:]])
+        positions = torch.arange(req.reused, len(req.input_ids)).unsqueeze(0)
+        out = self.model(input_ids=new_ids, position_ids=positions, past_key_values=row_cache, use_cache=True, num_logits_to_keep=1)
+        req.length = len(req.input_ids)
+        self.accept_token(req, self.sample(out.logits[0, -1], req))
+        return out.past_key_values
+
+    def add_row(self, req, row_cache):
+        if not self.rows:
+            self.keys = list(row_cache.key_cache)
+            self.values = list(row_cache.value_cache)
+            self.mask = torch.ones(1, req.length, dtype=torch.long)
+        else:
+            # Left-pad whichever side is shorter so every row's tokens end at the same cache column
+            target = max(self.mask.shape[1], req.length)
+            self.keys = [torch.cat([left_pad_cache(k, target), left_pad_cache(rk, target)], dim=0)
+                         for k, rk in zip(self.keys, row_cache.key_cache)]
+            self.values = [torch.cat([left_pad_cache(v, target), left_pad_cache(rv, target)], dim=0)
+                           for v, rv in zip(self.values, row_cache.value_cache)]
+            row_mask = torch.ones(1, req.length, dtype=torch.long)
+            self.mask = torch.cat([
+                torch.nn.functional.pad(self.mask, (target - self.mask.shape[1], 0)),
+                torch.nn.functional.pad(row_mask, (target - req.length, 0))
+            ], dim=0)
+        self.rows.append(req)
+
+    def decode_step(self):
+        input_ids = torch.tensor([[req.output_ids[-1]] for req in self.rows])
+        positions = torch.tensor([[req.length] for req in self.rows])
+        self.mask = torch.cat([self.mask, torch.ones(len(self.rows), 1, dtype=torch.long)], dim=1)
+        cache = make_dynamic_cache(self.keys, self.values)
+        out = self.model(input_ids=input_ids, attention_mask=self.mask, position_ids=positions, past_key_values=cache, use_cache=True)
+        self.keys, self.values = cache.key_cache, cache.value_cache
+        for i, req in enumerate(self.rows):
+            req.length += 1
+            self.accept_token(req, self.sample(out.logits[i, -1], req))
+
+    def lookup_draft(self, tokens):
+        # Prompt lookup: find the latest earlier occurrence of the trailing n-gram and propose what followed it
+        for n in range(self.LOOKUP_MAX_NGRAM, 0, -1):
+            if len(tokens) <= n:
+                continue
+            tail = tokens[-n:]
+            for start in range(len(tokens) - n - 1, -1, -1):
+                if tokens[start:start + n] == tail:
+                    draft = tokens[start + n:start + n + self.LOOKUP_DRAFT_TOKENS]
+                    if draft:
+                        return draft
+        return []
+
+    def model_draft(self, tokens):
+        shared = 0
+        for cached_id, new_id in zip(self.draft_ids, tokens):
+            if cached_id != new_id:
+                break
+            shared += 1
+        shared = min(shared, len(tokens) - 1)
+        if shared <= 0 or self.draft_cache is None:
+            self.draft_cache = transformers.DynamicCache()
+            shared = 0
+        else:
+            self.draft_cache.crop(shared)
+        feed = tokens[shared:]
+        position = shared
+        draft = []
+        for _ in range(self.MODEL_DRAFT_TOKENS):
+            positions = torch.arange(position, position + len(feed)).unsqueeze(0)
+            out = self.draft_model(input_ids=torch.tensor([feed]), position_ids=positions,
+                                   past_key_values=self.draft_cache, use_cache=True, num_logits_to_keep=1)
+            position += len(feed)
+            token = int(torch.argmax(out.logits[0, -1]))
+            draft.append(token)
+            feed = [token]
+        self.draft_ids = tokens + draft[:-1]
+        return draft
+
+    def speculative_step(self):
+        req = self.rows[0]
+        tokens = req.input_ids + req.output_ids
+        budget = min(req.max_new_tokens - len(req.output_ids), MODEL_CONTEXT_TOKENS - req.length - 2)
+        if budget < 2:
+            return False
+        draft = self.lookup_draft(tokens)
+        if not draft and self.draft_model is not None:
+            draft = self.model_draft(tokens)
+        draft = draft[:budget - 1]
+        if not draft:
+            return False
+        cache_len = self.keys[0].shape[2]
+        verify_ids = [req.output_ids[-1]] + draft
+        positions = torch.arange(req.length, req.length + len(verify_ids)).unsqueeze(0)
+        mask = torch.cat([self.mask, torch.ones(1, len(verify_ids), dtype=torch.long)], dim=1)
+        cache = make_dynamic_cache(self.keys, self.values)
+        # Every draft token is checked in this one forward pass
+        out = self.model(input_ids=torch.tensor([verify_ids]), attention_mask=mask, position_ids=positions,
+                         past_key_values=cache, use_cache=True)
+        logits = out.logits[0]
+        accepted = 0
+        correction = None
+        for i, token in enumerate(draft):
+            if not req.do_sample or req.temperature <= 0:
+                if int(torch.argmax(logits[i])) != token:
+                    break
+            else:
+                # Drafts are deterministic proposals, so accepting with probability p(token) and
+                # resampling from p without that token on rejection keeps the target distribution
+                probs = self.probabilities(logits[i], req)
+                if float(torch.rand(1, generator=req.generator)) >= float(probs[token]):
+                    probs[token] = 0
+                    correction = int(torch.multinomial(probs / probs.sum(), 1, generator=req.generator))
+                    break
+            accepted += 1
+        emitted = draft[:accepted]
+        emitted.append(correction if correction is not None else self.sample(logits[accepted], req))
+        req.drafted += len(draft)
+        req.accepted += accepted
+        count = 0
+        for token in emitted:
+            count += 1
+            self.accept_token(req, token)
+            if req.finished:
+                break
+        # Keep cache entries only for tokens that were fed and accepted
+        self.keys = [k[:, :, :cache_len + count] for k in cache.key_cache]
+        self.values = [v[:, :, :cache_len + count] for v in cache.value_cache]
+        self.mask = torch.ones(1, cache_len + count, dtype=torch.long)
+        req.length += count
+        return True
+
+    def drop_finished(self):
+        keep = []
+        for i, req in enumerate(self.rows):
+            if req.finished:
+                self.finish(req, [k[i:i + 1, :, -req.length:].clone() for k in self.keys],
+                            [v[i:i + 1, :, -req.length:].clone() for v in self.values])
+            else:
+                keep.append(i)
+        if len(keep) == len(self.rows):
+            return
+        if not keep:
+            self.reset()
+            return
+        index = torch.tensor(keep)
+        self.rows = [self.rows[i] for i in keep]
+        self.mask = self.mask.index_select(0, index)
+        # Columns that are padding for every remaining row can go
+        first = int(self.mask.any(dim=0).int().argmax())
+        self.keys = [k.index_select(0, index)[:, :, first:] for k in self.keys]
+        self.values = [v.index_select(0, index)[:, :, first:] for v in self.values]
+        self.mask = self.mask[:, first:]
+
+    def reset(self):
+        self.rows = []
+        self.keys = []
+        self.values = []
+        self.mask = None
+
+    def sample(self, logits, req):
+        if not req.do_sample or req.temperature <= 0:
+            return int(torch.argmax(logits))
+        return int(torch.multinomial(self.probabilities(logits, req), 1, generator=req.generator))
+
+    def probabilities(self, logits, req):
+        # Temperature, then top-k, then top-p, in the order transformers' logits warpers apply them
+        logits = logits.float() / req.temperature
+        if 0 < self.top_k < logits.shape[-1]:
+            logits = logits.masked_fill(logits < torch.topk(logits, self.top_k).values[-1], float("-inf"))
+        if self.top_p < 1.0:
+            sorted_logits, order = torch.sort(logits, descending=True)
+            probs = torch.softmax(sorted_logits, dim=-1)
+            # Drop a token once the more likely ones already cover top_p; the most likely token always stays
+            drop = (probs.cumsum(dim=-1) - probs) >= self.top_p
+            logits = logits.index_fill(0, order[drop], float("-inf"))
+        return torch.softmax(logits, dim=-1)
+
+    def accept_token(self, req, token):
+        if req.first_token_time is None:
+            req.first_token_time = time.time()
+        req.output_ids.append(token)
+        self.token_count += 1
+        if token == self.tokenizer.eos_token_id:
+            req.finished = True
+            return
+        if req.on_token:
+            text = self.tokenizer.decode(req.output_ids, skip_special_tokens=True)
+            # Hold back partial multi-byte characters until the next token completes them
+            if text.startswith(req.emitted) and not text.endswith("\ufffd") and len(text) > len(req.emitted):
+                req.on_token(text[len(req.emitted):])
+                req.emitted = text
+        if len(req.output_ids) >= req.max_new_tokens or req.length + 1 >= MODEL_CONTEXT_TOKENS or req.cancelled:
+            req.finished = True
+
+    def finish(self, req, keys, values):
+        req.response = self.tokenizer.decode(req.output_ids, skip_special_tokens=True).strip()
+        if req.chat_id and keys is not None:
+            tokens = (req.input_ids + req.output_ids)[:req.length]
+            self.kv_cache.put(req.chat_id, tokens, make_dynamic_cache(keys, values))
+        if req.cache_key and not req.from_cache and not req.cancelled:
+            self.response_cache.put(req.cache_key, req.response, req.output_ids)
+        elapsed = time.time() - req.start_time
+        if self.on_status and req.from_cache:
+            self.on_status(
+                f"Ready (cached response in {elapsed * 1000:.0f} ms, "
+                f"cache hits {self.response_cache.hits} / misses {self.response_cache.misses})", 100, 0
+            )
+        elif self.on_status:
+            drafts = f", drafts accepted {req.accepted}/{req.drafted}" if req.drafted else ""
+            self.on_status(
+                f"Ready ({self.stats.get('precision', 'fp32')}, {len(req.output_ids) / elapsed:.1f} tok/s, "
+                f"reused {req.reused}/{len(req.input_ids)} prompt tokens, "
+                f"first token {req.first_token_time - req.start_time:.2f}s{drafts})", 100, 0
+            )
+        if req.future and not req.future.done():
+            req.future.set_result(req.response)
+
+class LocalAPIServer:
+    # OpenAI-compatible endpoint on localhost so other local tools can share the warm models
+    MAX_BODY_BYTES = 1024 * 1024
+
+    def __init__(self, assistant, host="127.0.0.1", port=8765, max_concurrent=2):
+        self.assistant = assistant
+        self.host = host
+        self.port = port
+        self.max_concurrent = max(1, max_concurrent)
+        self.loop = None
+        self.semaphore = None
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        # A failure here (e.g. the port is taken) would otherwise end silently with the thread
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            self.assistant.update_status(f"Local API server stopped on {self.host}:{self.port}: {str(e)}", 100, 0)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.semaphore = asyncio.Semaphore(self.max_concurrent)
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").strip()
+            if not request_line:
+                return
+            method, path = request_line.split(" ")[:2]
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+            if length > self.MAX_BODY_BYTES:
+                await self.send_error(writer, 413, "Request body too large.")
+                return
+            body = await reader.readexactly(length) if length else b""
+            path = path.split("?")[0]
+            if method == "GET" and path == "/v1/models":
+                await self.send_json(writer, 200, {"object": "list", "data": [
+                    {"id": CHAT_MODEL_NAME, "object": "model", "owned_by": "local"},
+                    {"id": "runwayml/stable-diffusion-v1-5", "object": "model", "owned_by": "local"}
+                ]})
+                return
+            if method != "POST" or path not in ("/v1/chat/completions", "/v1/images/generations"):
+                await self.send_error(writer, 404, f"No route for {method} {path}.")
+                return
+            try:
+                payload = json.loads(body or b"{}")
+            except json.JSONDecodeError:
+                await self.send_error(writer, 400, "Body must be JSON.")
+                return
+            async with self.semaphore:
+                if path == "/v1/chat/completions":
+                    await self.chat_completions(payload, writer)
+                else:
+                    await self.image_generations(payload, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            try:
+                await self.send_error(writer, 500, str(e))
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def send_json(self, writer, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+
+    @staticmethod
+    def number(payload, name, default, kind=int):
+        # JSON numbers only: strings such as "7" are rejected with a 400 rather than failing inside the model
+        value = payload.get(name)
+        if value is None:
+            return default
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or (kind is int and value != int(value)):
+            raise ValueError(f"{name} must be {'an integer' if kind is int else 'a number'}.")
+        return kind(value)
+
+    async def send_error(self, writer, status, message):
+        await self.send_json(writer, status, {"error": {"message": message, "type": HTTPStatus(status).phrase.lower().replace(" ", "_")}})
+
+    async def submit(self, writer, kind, fn, request=None):
+        try:
+            return self.assistant.scheduler.submit(kind, fn, InferenceScheduler.PRIORITY_API, request=request)
+        except queue.Full:
+            await self.send_error(writer, 429, "Too many queued requests, retry later.")
+            return None
+
+    async def chat_completions(self, payload, writer):
+        messages = payload.get("messages") or []
+        if not messages or messages[-1].get("role") != "user":
+            await self.send_error(writer, 400, "messages must end with a user message.")
+            return
+        roles = {"user": "User", "assistant": "AI", "system": "System"}
+        history = [{"role": roles.get(msg.get("role"), "User"), "content": str(msg.get("content", ""))} for msg in messages[:-1]]
+        try:
+            temperature = self.number(payload, "temperature", 0.7, float)
+            max_tokens = max(1, min(self.number(payload, "max_tokens", 256), 1024))
+            seed = self.number(payload, "seed", None)
+        except ValueError as e:
+            await self.send_error(writer, 400, str(e))
+            return
+        stream = bool(payload.get("stream"))
+        tokens = asyncio.Queue()
+
+        def on_token(text):
+            self.loop.call_soon_threadsafe(tokens.put_nowait, text)
+
+        request = GenerationRequest(
+            str(messages[-1].get("content", "")), max_tokens, temperature=temperature, do_sample=temperature > 0,
+            on_token=on_token if stream else None, seed=seed, history=history
+        )
+        job = await self.submit(writer, "chat", lambda job: self.assistant.run_request(job.request), request)
+        if job is None:
+            return
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        if not stream:
+            try:
+                response = await asyncio.wrap_future(job.future)
+            except Exception as e:
+                await self.send_error(writer, 500, f"Generation failed: {str(e)}")
+                return
+            await self.send_json(writer, 200, {
+                "id": completion_id, "object": "chat.completion", "created": created, "model": CHAT_MODEL_NAME,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": response},
+                             "finish_reason": "length" if len(request.output_ids) >= max_tokens else "stop"}],
+                "usage": {"prompt_tokens": len(request.input_ids), "completion_tokens": len(request.output_ids),
+                          "total_tokens": len(request.input_ids) + len(request.output_ids)}
+            })
+            return
+        job.future.add_done_callback(lambda future: self.loop.call_soon_threadsafe(tokens.put_nowait, None))
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n")
+
+        def chunk(delta, finish_reason=None):
+            data = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": CHAT_MODEL_NAME,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            return f"data: {json.dumps(data)}\n\n".encode("utf-8")
+
+        try:
+            writer.write(chunk({"role": "assistant"}))
+            while True:
+                text = await tokens.get()
+                if text is None:
+                    break
+                writer.write(chunk({"content": text}))
+                await writer.drain()
+            if not job.future.cancelled() and job.future.exception():
+                # The 200 header is already out, so the failure goes in the stream as an error event
+                error = {"error": {"message": f"Generation failed: {str(job.future.exception())}", "type": "internal_server_error"}}
+                writer.write(f"data: {json.dumps(error)}\n\n".encode("utf-8"))
+            else:
+                writer.write(chunk({}, "length" if len(request.output_ids) >= max_tokens else "stop"))
+            writer.write(b"data: [DONE]\n\n")
+            await writer.drain()
+        except ConnectionError:
+            # Client went away; free the batch slot
+            job.cancel()
+
+    async def image_generations(self, payload, writer):
+        prompt = str(payload.get("prompt", "")).strip()
+        if not prompt:
+            await self.send_error(writer, 400, "prompt is required.")
+            return
+        try:
+            n = max(1, min(self.number(payload, "n", 1), 4))
+            seed = self.number(payload, "seed", None)
+        except ValueError as e:
+            await self.send_error(writer, 400, str(e))
+            return
+        steps, size = choose_image_settings(self.assistant.config)
+        seeds = [seed + i for i in range(n)] if seed is not None else None
+        job = await self.submit(
+            writer, "image",
+            lambda job: self.assistant.run_image_pipeline(job, prompt, steps, size, n, seeds, str(payload.get("negative_prompt", "")))
+        )
+        if job is None:
+            return
+        images = await asyncio.wrap_future(job.future)
+        data = []
+        for image in images:
+            buffer = io.BytesIO()
+            image.save(buffer, format="PNG")
+            data.append({"b64_json": base64.b64encode(buffer.getvalue()).decode("ascii"), "revised_prompt": prompt})
+        await self.send_json(writer, 200, {"created": int(time.time()), "data": data})
+
 class AIAssistant:
     def __init__(self, root, config):
         self.root = root
@@ -748,24 +3140,74 @@ class AIAssistant:
         self.config = config
         self.model = None
         self.tokenizer = None
+        self.model_stats = {}
+        self.batcher = None
+        self.context = None
         self.image_pipe = None
+        self.image_preset = None
+        self.image_variant = None
         self.clip_model = None
         self.clip_processor = None
         self.status_var = tk.StringVar()
         self.status_var.set("Initializing...")
         self.progress_var = tk.DoubleVar()
-        self.chats = self.load_chat_history()
+        self.chat_store = ChatStore(on_status=self.update_status, cache_chats=self.config.get("chat_cache_size", 16))
         self.current_chat_id = None
         self.active_chat_tabs = {}
         self.chat_frames = {}
         self.chat_displays = {}
+        self.transcripts = {}
         self.input_fields = {}
         self.chat_length_vars = {}
+        self.image_count_vars = {}
+        self.stream_marks = {}
+        self.stream_ids = itertools.count()
+        self.kv_cache = ChatKVCache(self.config.get("kv_cache_mb", 512))
+        self.response_cache = ResponseCache(RESPONSE_CACHE_DIR, self.config.get("response_cache_mb", 64))
+        self.image_cache = ImageResultCache(IMAGE_CACHE_DIR, self.config.get("image_cache_mb", 256))
+        self.prompt_embeds = OrderedDict()
+        self.retrieval = RetrievalIndex(RETRIEVAL_INDEX_DIR, self.encode_texts if self.config.get("retrieval_embeddings") else None)
+        self.image_store = ImageEmbeddingStore(IMAGE_INDEX_DIR)
+        self.chat_search = ChatSearchIndex(on_status=self.update_status)
+        self.search_window = None
+        self.search_results = []
+        profile = active_profile(self.config)
+        self.scheduler = InferenceScheduler(
+            self.config.get("max_queued_jobs", 8),
+            self.config.get("torch_threads") or (profile and profile["torch_threads"]),
+            profile["interop_threads"] if profile else 1
+        )
+        self.tab_jobs = {}
+        self.config_lock = threading.Lock()
+        self.config_seq = itertools.count(1)
+        self.config_written = 0
         self.game_instance = None
+        # Nothing is loaded up front; each model is pulled in by the first job that needs it
+        idle_seconds = self.config.get("model_idle_minutes", 10) * 60
+        if self.config.get("offline_mode"):
+            # Read by huggingface_hub at import time, which the lazy imports have not done yet
+            os.environ["HF_HUB_OFFLINE"] = "1"
+            os.environ["TRANSFORMERS_OFFLINE"] = "1"
+        self.registry = ModelRegistry(offline=self.config.get("offline_mode", False))
+        self.models = ModelGovernor(choose_ram_budget_mb(self.config), self.update_status)
+        self.register_chat_model()
+        self.models.register("image", "Stable Diffusion", self.load_image_pipeline, self.unload_image_pipeline, 4200, idle_seconds)
+        self.models.register("clip", "CLIP", self.load_clip_model, self.unload_clip_model, 600, idle_seconds)
         self.create_gui()
-        threading.Thread(target=self.load_model, daemon=True).start()
-        threading.Thread(target=self.load_image_pipeline, daemon=True).start()
-        threading.Thread(target=self.load_clip_model, daemon=True).start()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.root.after(60000, self.check_idle_models)
+        if calibration_current(self.config):
+            self.root.after(1000, self.warm_imports)
+        else:
+            # First run (or new hardware); in the background so the first chat is not kept waiting.
+            # A chat model loaded before it finishes is reloaded if the profile picks another dtype.
+            self.run_calibration(InferenceScheduler.PRIORITY_BACKGROUND)
+        self.root.after(1000, self.sync_indexes)
+        self.api_server = None
+        if self.config.get("api_server"):
+            self.api_server = LocalAPIServer(self, port=self.config.get("api_port", 8765),
+                                             max_concurrent=self.config.get("api_max_concurrent", 2))
+            self.api_server.start()
 
     def update_status(self, message, progress=0, estimated_time=None):
         self.root.after(0, lambda: self.status_var.set(
@@ -773,70 +3215,302 @@ class AIAssistant:
         ))
         self.root.after(0, lambda: self.progress_var.set(progress))
 
-    def simulate_progress(self, task_name, total_time):
-        steps = 20
-        step_time = total_time / steps
-        for i in range(steps + 1):
-            progress = (i / steps) * 100
-            remaining_time = step_time * (steps - i)
-            self.update_status(task_name, progress, round(remaining_time, 1))
-            time.sleep(step_time)
-        self.update_status("Ready", 100, 0)
-
     def load_model(self):
-        eta = {"Eco": 20, "Balanced": 40, "Max": 60}[self.config["power_level"]]
-        self.simulate_progress("Loading TinyLlama model...", eta)
-        model_name = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
+        precision = choose_model_precision(self.config)
+        # Tokenizer, weights and (for int8) quantization are one event each; sharded checkpoints add one per shard
+        tracker = ProgressTracker("Loading TinyLlama", 3 if precision == "int8" else 2, self.update_status)
         try:
-            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-            self.model = AutoModelForCausalLM.from_pretrained(
-                model_name,
-                torch_dtype=torch.float32,
-                device_map="cpu"
+            model_path = self.registry.resolve("chat")
+            with hf_load_progress(tracker):
+                self.tokenizer = transformers.AutoTokenizer.from_pretrained(model_path, local_files_only=True)
+                tracker.advance()
+                # safetensors are memory-mapped and copied straight into the target dtype, one tensor at a time
+                model = transformers.AutoModelForCausalLM.from_pretrained(
+                    model_path,
+                    torch_dtype=torch.bfloat16 if precision == "bf16" else torch.float32,
+                    device_map="cpu",
+                    low_cpu_mem_usage=True,
+                    use_safetensors=True,
+                    local_files_only=True
+                )
+                tracker.advance()
+            if precision == "int8":
+                model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+                tracker.advance()
+            model.eval()
+            self.model = model
+            revision = self.registry.revision("chat")
+            self.model_stats = {
+                "precision": precision,
+                "revision": revision,
+                "tokens_per_sec": None
+            }
+            if self.context is None:
+                self.context = ContextManager(self.tokenizer)
+            draft_model = self.load_draft_model()
+            self.batcher = BatchGenerator(
+                self.model, self.tokenizer, self.kv_cache, self.build_chat_prompt, self.scheduler,
+                self.config.get("max_batch_size", 4), self.update_status, self.model_stats,
+                self.response_cache, f"{CHAT_MODEL_NAME}@{revision}:{precision}",
+                self.config.get("speculative_decoding", True), draft_model
             )
-            self.update_status("Ready", 100, 0)
+            return [self.model, draft_model]
         except Exception as e:
             self.update_status(f"Error loading model: {str(e)}", 0)
             self.root.after(0, lambda: tk.messagebox.showerror("Error", "Failed to load chat model."))
+            raise
+
+    def unload_model(self):
+        # KV caches belong to the unloaded weights and are the next biggest allocation
+        self.batcher = None
+        self.model = None
+        self.kv_cache.drop()
+
+    def load_draft_model(self):
+        # Optional small model sharing TinyLlama's tokenizer; only used when it is already on disk
+        path = self.config.get("draft_model_path")
+        if not self.config.get("speculative_decoding", True) or not path or not os.path.isdir(path):
+            return None
+        try:
+            draft = transformers.AutoModelForCausalLM.from_pretrained(path, torch_dtype=torch.float32, local_files_only=True, low_cpu_mem_usage=True)
+            if draft.config.vocab_size != self.model.config.vocab_size:
+                return None
+            return draft.eval()
+        except Exception:
+            return None
 
     def load_image_pipeline(self):
-        eta = {"Eco": 40, "Balanced": 80, "Max": 120}[self.config["power_level"]]
-        self.simulate_progress("Loading Stable Diffusion model...", eta)
+        # Each pipeline component (UNet, VAE, text encoder, ...) counts as one event
+        tracker = ProgressTracker("Loading Stable Diffusion", 0, self.update_status)
         try:
-            self.image_pipe = StableDiffusionPipeline.from_pretrained(
-                "runwayml/stable-diffusion-v1-5",
-                torch_dtype=torch.float32,
-                use_auth_token=False
-            )
+            pipe_path = self.registry.resolve("image")
+            preset_name = choose_image_preset(self.config)
+            preset = IMAGE_PRESETS[preset_name]
+            bf16 = preset["bf16"] and image_bf16_supported(self.config)
+            with hf_load_progress(tracker, "diffusers"):
+                self.image_pipe = diffusers.StableDiffusionPipeline.from_pretrained(
+                    pipe_path,
+                    torch_dtype=torch.bfloat16 if bf16 else torch.float32,
+                    low_cpu_mem_usage=True,
+                    use_safetensors=True,
+                    local_files_only=True
+                )
             self.image_pipe = self.image_pipe.to("cpu")
-            self.update_status("Ready", 100, 0)
+            if preset["scheduler"] == "dpm++":
+                self.image_pipe.scheduler = diffusers.DPMSolverMultistepScheduler.from_config(
+                    self.image_pipe.scheduler.config, algorithm_type="dpmsolver++", use_karras_sigmas=True
+                )
+            if preset["attention_slicing"]:
+                self.image_pipe.enable_attention_slicing(preset["attention_slicing"])
+            if preset["vae_slicing"]:
+                self.image_pipe.enable_vae_slicing()
+            if preset["vae_tiling"]:
+                self.image_pipe.enable_vae_tiling()
+            if preset["channels_last"]:
+                self.image_pipe.unet.to(memory_format=torch.channels_last)
+            self.image_preset = preset_name
+            self.image_variant = preset_variant(self.config, preset_name)
+            return list(self.image_pipe.components.values())
         except Exception as e:
             self.update_status(f"Error loading image pipeline: {str(e)}", 0)
             self.root.after(0, lambda: tk.messagebox.showerror("Error", "Failed to load image model."))
+            raise
+
+    def unload_image_pipeline(self):
+        self.image_pipe = None
+        self.image_preset = None
+        self.image_variant = None
+        # Embeddings belong to the text encoder (and dtype) they came from
+        self.prompt_embeds.clear()
 
     def load_clip_model(self):
-        eta = {"Eco": 15, "Balanced": 30, "Max": 45}[self.config["power_level"]]
-        self.simulate_progress("Loading CLIP model...", eta)
+        tracker = ProgressTracker("Loading CLIP", 2, self.update_status)
         try:
-            self.clip_model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-            self.clip_processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-            self.update_status("Ready", 100, 0)
+            clip_path = self.registry.resolve("clip")
+            with hf_load_progress(tracker):
+                self.clip_model = transformers.CLIPModel.from_pretrained(
+                    clip_path, low_cpu_mem_usage=True, use_safetensors=True, local_files_only=True
+                )
+                tracker.advance()
+                self.clip_processor = transformers.CLIPProcessor.from_pretrained(clip_path, local_files_only=True)
+                tracker.advance()
+            return [self.clip_model]
         except Exception as e:
             self.update_status(f"Error loading CLIP model: {str(e)}", 0)
             self.root.after(0, lambda: tk.messagebox.showerror("Error", "Failed to load vision model."))
+            raise
 
-    def load_chat_history(self):
-        self.simulate_progress("Loading chat history...", 1)
-        with open(CHAT_HISTORY_FILE, 'r') as f:
-            chats = json.load(f)["chats"]
-        self.update_status("Ready", 100, 0)
-        return chats
+    def unload_clip_model(self):
+        self.clip_model = None
+        self.clip_processor = None
+
+    def register_chat_model(self):
+        precision = choose_model_precision(self.config)
+        self.models.register("chat", f"TinyLlama ({precision})", self.load_model, self.unload_model, WEIGHT_MB[precision])
+
+    def run_calibration(self, priority=InferenceScheduler.PRIORITY_INTERACTIVE):
+        def done(future):
+            self.root.after(0, self.calibration_finished, future)
+        try:
+            self.scheduler.submit("maintenance", lambda job: calibrate_hardware(self.update_status),
+                                  priority, on_done=done)
+        except queue.Full:
+            tk.messagebox.showwarning("Busy", "Too many requests are queued. Please wait for one to finish.")
+
+    def calibration_finished(self, future):
+        if future.exception():
+            self.update_status(f"Hardware calibration failed: {str(future.exception())}", 0)
+            return
+        self.config["calibration"] = future.result()
+        self.save_config()
+        self.apply_profile()
+        self.update_status(f"Calibrated: {self.profile_summary()}", 100, 0)
+
+    def save_config(self):
+        # Serialized here so later changes on the Tk thread cannot race the dump; the disk write is a
+        # maintenance job. on_close writes the final state in case one is still queued.
+        seq, data = next(self.config_seq), json.dumps(self.config, indent=4)
+        try:
+            self.scheduler.submit("maintenance", lambda job: self.write_config(seq, data), InferenceScheduler.PRIORITY_BACKGROUND)
+        except queue.Full:
+            threading.Thread(target=self.write_config, args=(seq, data), daemon=True).start()
+
+    def write_config(self, seq, data):
+        # An older snapshot that arrives late never overwrites a newer one
+        with self.config_lock:
+            if seq <= self.config_written:
+                return
+            tmp_path = CONFIG_FILE + ".tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(data)
+            os.replace(tmp_path, CONFIG_FILE)
+            self.config_written = seq
+
+    def profile_summary(self):
+        profile = active_profile(self.config)
+        if not profile:
+            return "not calibrated yet"
+        return (f"{profile['dtype']}, {profile['torch_threads']} threads, ~{profile['tokens_per_sec']} tok/s, "
+                f"up to {profile['max_new_tokens']} tokens, {profile['diffusion_steps']} steps at {profile['image_size']}px")
+
+    def image_preset_summary(self):
+        preset = choose_image_preset(self.config)
+        stats = (self.config.get("image_preset_stats") or {}).get(preset)
+        if not stats:
+            return f"{preset} (not measured yet)"
+        return (f"{preset}: {stats['seconds_per_image']} s/image at {stats['steps']} steps, {stats['size']}px, "
+                f"peak RSS {stats['peak_rss_mb']} MB")
+
+    def image_preset_measured(self, preset, stats):
+        self.config.setdefault("image_preset_stats", {})[preset] = stats
+        self.save_config()
+        if hasattr(self, "image_preset_var"):
+            self.image_preset_var.set(f"Image preset: {self.image_preset_summary()}")
+
+    def apply_profile(self):
+        profile = active_profile(self.config)
+        if profile and not self.config.get("torch_threads"):
+            self.scheduler.set_threads(profile["torch_threads"], profile["interop_threads"])
+        self.register_chat_model()
+        if hasattr(self, "profile_var"):
+            self.profile_var.set(f"Profile: {self.profile_summary()}")
+            self.image_preset_var.set(f"Image preset: {self.image_preset_summary()}")
+        # A new dtype needs a reload; unload on the worker so no batch is mid-decode
+        if self.models.is_loaded("chat") and self.model_stats.get("precision") != choose_model_precision(self.config):
+            try:
+                self.scheduler.submit("maintenance", lambda job: self.models.unload("chat", "profile changed"),
+                                      InferenceScheduler.PRIORITY_BACKGROUND)
+            except queue.Full:
+                pass
+        if self.models.is_loaded("image") and self.image_preset != choose_image_preset(self.config):
+            try:
+                self.scheduler.submit("maintenance", lambda job: self.models.unload("image", "preset changed"),
+                                      InferenceScheduler.PRIORITY_BACKGROUND)
+            except queue.Full:
+                pass
+
+    def warm_imports(self):
+        # Once the window is up, pull torch and transformers in on the worker so the first chat
+        # only pays for loading weights
+        try:
+            self.scheduler.submit("maintenance", lambda job: transformers.AutoModelForCausalLM, InferenceScheduler.PRIORITY_BACKGROUND)
+        except queue.Full:
+            pass
 
-    def save_chat_history(self):
-        self.simulate_progress("Saving chat history...", 1)
-        with open(CHAT_HISTORY_FILE, 'w') as f:
-            json.dump({"chats": self.chats}, f, indent=4)
+    def check_idle_models(self):
+        # Unloading goes through the scheduler so it never races a running job
+        try:
+            self.scheduler.submit("maintenance", lambda job: self.models.unload_idle(), InferenceScheduler.PRIORITY_BACKGROUND)
+            self.scheduler.submit("maintenance", lambda job: self.retrieval.save(), InferenceScheduler.PRIORITY_BACKGROUND)
+            self.scheduler.submit("maintenance", lambda job: (self.response_cache.flush(), self.image_cache.flush()),
+                                  InferenceScheduler.PRIORITY_BACKGROUND)
+        except queue.Full:
+            pass
+        self.root.after(60000, self.check_idle_models)
+
+    def sync_indexes(self):
+        # Loads the saved indexes and picks up attachments and messages added while they were not running.
+        # Only chats the indexes are behind on are read from the store.
+        counts = {chat_id: entry["count"] for chat_id, entry in self.chat_store.index.items()}
+
+        def sync(job):
+            search_counts = self.chat_search.counts()
+            retrieval_counts = self.retrieval.chat_counts()
+            for chat_id in set(search_counts) - set(counts):
+                self.chat_search.remove(chat_id)
+            for chat_id, count in counts.items():
+                start = min(search_counts.get(chat_id, 0), retrieval_counts.get(chat_id, 0))
+                if start < count:
+                    messages = self.chat_store.read_messages(chat_id, start)
+                    self.chat_search.append(chat_id, start, messages)
+                    self.retrieval.note_chat(chat_id, start, messages)
+            self.retrieval.sync_attachments(ATTACHMENTS_DIR)
+            self.retrieval.apply_pending_chats()
+            self.retrieval.save()
+        try:
+            self.scheduler.submit("maintenance", sync, InferenceScheduler.PRIORITY_BACKGROUND)
+        except queue.Full:
+            pass
+
+    def encode_texts(self, texts):
+        # CLIP's text tower doubles as a small sentence encoder; it only sees the first 77 tokens of a chunk
+        self.models.acquire("clip")
+        inputs = self.clip_processor(text=texts, return_tensors="pt", padding=True, truncation=True)
+        with torch.inference_mode():
+            features = self.clip_model.get_text_features(**inputs)
+        return torch.nn.functional.normalize(features, dim=-1).numpy()
+
+    def encode_images(self, paths):
+        self.models.acquire("clip")
+        images = [Image.open(path).convert("RGB") for path in paths]
+        inputs = self.clip_processor(images=images, return_tensors="pt")
+        with torch.inference_mode():
+            features = self.clip_model.get_image_features(**inputs)
+        return torch.nn.functional.normalize(features, dim=-1).numpy()
+
+    def search_images(self, query, k=6):
+        # Images saved since the last search are encoded first; everything seen before is a matrix row
+        self.image_store.sync([ATTACHMENTS_DIR, GENERATED_IMAGES_DIR], self.encode_images, self.update_status)
+        results = self.image_store.search(query, self.encode_texts, k)
         self.update_status("Ready", 100, 0)
+        return results
+
+    def record_messages(self, chat_id, messages):
+        # Chats deleted while a job was running are not recreated
+        if chat_id not in self.chat_store.index:
+            return
+        start = self.chat_store.append(chat_id, messages)
+        self.retrieval.note_chat(chat_id, start, messages)
+        self.chat_search.append(chat_id, start, messages)
+
+    def on_close(self):
+        # Let the writers commit anything still queued before the process exits
+        self.chat_store.flush()
+        self.chat_search.flush()
+        self.response_cache.flush()
+        self.image_cache.flush()
+        self.write_config(next(self.config_seq), json.dumps(self.config, indent=4))
+        self.root.destroy()
 
     def create_gui(self):
         top_frame = tk.Frame(self.root)
@@ -847,6 +3521,11 @@ class AIAssistant:
         self.chat_list.pack(side=tk.LEFT, padx=5)
         self.chat_list.bind('<<ListboxSelect>>', self.load_chat)
         self.update_chat_list()
+        self.search_var = tk.StringVar()
+        search_entry = tk.Entry(top_frame, textvariable=self.search_var, width=25)
+        search_entry.pack(side=tk.LEFT, padx=5)
+        search_entry.bind('<Return>', lambda event: self.search_chats())
+        tk.Button(top_frame, text="Search Chats", command=self.search_chats).pack(side=tk.LEFT, padx=5)
 
         self.notebook = ttk.Notebook(self.root)
         self.notebook.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
@@ -857,7 +3536,7 @@ class AIAssistant:
 
         self.video_frame = tk.Frame(self.notebook)
         self.notebook.add(self.video_frame, text="Video Editor")
-        self.video_app = VideoApp(self.video_frame)
+        self.video_app = VideoApp(self.video_frame, self.update_status)
 
         self.games_frame = tk.Frame(self.notebook)
         self.notebook.add(self.games_frame, text="Games")
@@ -897,7 +3576,21 @@ class AIAssistant:
         tk.Radiobutton(frame, text="Eco", variable=self.power_var, value="Eco").pack(side=tk.LEFT)
         tk.Radiobutton(frame, text="Balanced", variable=self.power_var, value="Balanced").pack(side=tk.LEFT)
         tk.Radiobutton(frame, text="Max", variable=self.power_var, value="Max").pack(side=tk.LEFT)
-        tk.Button(frame, text="?", command=lambda: tk.messagebox.showinfo("Power Level", "Eco: Minimal resources. Balanced: Good performance. Max: Best quality, high resource use.")).pack(side=tk.LEFT, padx=5)
+        tk.Button(frame, text="?", command=lambda: tk.messagebox.showinfo("Power Level", "Eco: Minimal resources. Balanced: Good performance. Max: Best quality, high resource use.\n\nEach level is calibrated on this machine into thread counts, model precision, reply length and image steps/size.")).pack(side=tk.LEFT, padx=5)
+        self.profile_var = tk.StringVar(value=f"Profile: {self.profile_summary()}")
+        tk.Label(self.settings_frame, textvariable=self.profile_var, wraplength=500).pack(pady=2)
+        self.image_preset_var = tk.StringVar(value=f"Image preset: {self.image_preset_summary()}")
+        tk.Label(self.settings_frame, textvariable=self.image_preset_var, wraplength=500).pack(pady=2)
+        tk.Button(self.settings_frame, text="Recalibrate Hardware", command=self.run_calibration).pack(pady=2)
+
+        tk.Label(self.settings_frame, text="Deterministic Replies:").pack(pady=5)
+        self.deterministic_var = tk.StringVar(value=self.config.get("deterministic_mode", "Off"))
+        frame = tk.Frame(self.settings_frame)
+        frame.pack()
+        tk.Radiobutton(frame, text="Off", variable=self.deterministic_var, value="Off").pack(side=tk.LEFT)
+        tk.Radiobutton(frame, text="Greedy", variable=self.deterministic_var, value="Greedy").pack(side=tk.LEFT)
+        tk.Radiobutton(frame, text="Fixed Seed", variable=self.deterministic_var, value="Seeded").pack(side=tk.LEFT)
+        tk.Button(frame, text="?", command=lambda: tk.messagebox.showinfo("Deterministic Replies", "Greedy or Fixed Seed give the same reply to the same prompt, so repeated questions are answered instantly from the response cache. Fixed Seed replies run on their own (no batching, drafting or KV-cache reuse), so the same prompt, history and settings reproduce the reply on this machine. Off: varied replies, no caching.")).pack(side=tk.LEFT, padx=5)
 
         tk.Button(self.settings_frame, text="Save Settings", command=self.save_settings).pack(pady=10)
 
@@ -922,8 +3615,9 @@ class AIAssistant:
         self.config["performance_mode"] = self.performance_var.get()
         self.config["image_quality"] = self.image_quality_var.get()
         self.config["power_level"] = self.power_var.get()
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(self.config, f, indent=4)
+        self.config["deterministic_mode"] = self.deterministic_var.get()
+        self.save_config()
+        self.apply_profile()
         self.root.after(0, lambda: tk.messagebox.showinfo("Settings Saved", "Settings have been saved."))
 
     def add_chat_tab(self, tab_name):
@@ -934,6 +3628,7 @@ class AIAssistant:
         chat_display = scrolledtext.ScrolledText(frame, wrap=tk.WORD, height=20, state='disabled')
         chat_display.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
         self.chat_displays[tab_name] = chat_display
+        self.transcripts[tab_name] = TranscriptView(chat_display)
 
         input_frame = tk.Frame(frame)
         input_frame.pack(pady=5, fill=tk.X)
@@ -942,6 +3637,9 @@ class AIAssistant:
         self.chat_length_vars[tab_name] = tk.StringVar(value=self.config["max_chat_length"])
         tk.Radiobutton(input_frame, text="Short", variable=self.chat_length_vars[tab_name], value="Short").pack(side=tk.LEFT)
         tk.Radiobutton(input_frame, text="Long", variable=self.chat_length_vars[tab_name], value="Long").pack(side=tk.LEFT)
+        tk.Label(input_frame, text="Images:").pack(side=tk.LEFT, padx=5)
+        self.image_count_vars[tab_name] = tk.StringVar(value="1")
+        tk.Spinbox(input_frame, from_=1, to=8, width=3, textvariable=self.image_count_vars[tab_name]).pack(side=tk.LEFT)
         
         input_field = tk.Entry(input_frame)
         input_field.pack(side=tk.LEFT, padx=5, fill=tk.X, expand=True)
@@ -951,21 +3649,18 @@ class AIAssistant:
         tk.Button(input_frame, text="Send", command=lambda tn=tab_name: self.process_input(tn)).pack(side=tk.LEFT, padx=5)
         tk.Button(input_frame, text="Attach", command=lambda tn=tab_name: self.attach_file(tn)).pack(side=tk.LEFT, padx=5)
         tk.Button(input_frame, text="Generate Image", command=lambda tn=tab_name: self.generate_image(tn)).pack(side=tk.LEFT, padx=5)
+        tk.Button(input_frame, text="Stop", command=lambda tn=tab_name: self.cancel_tab_jobs(tn)).pack(side=tk.LEFT, padx=5)
 
     def update_chat_list(self):
         self.chat_list.delete(0, tk.END)
-        for chat_id in self.chats:
-            self.chat_list.insert(tk.END, f"Chat {chat_id} - {self.chats[chat_id]['timestamp']}")
+        for chat_id, entry in self.chat_store.index.items():
+            title = f" - {entry['title']}" if entry["title"] else ""
+            self.chat_list.insert(tk.END, f"Chat {chat_id} - {entry['timestamp']}{title}")
 
     def new_chat(self):
-        self.simulate_progress("Creating new chat...", 1)
-        chat_id = str(len(self.chats) + 1)
-        self.chats[chat_id] = {
-            "timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "messages": []
-        }
+        chat_id = str(len(self.chat_store.index) + 1)
+        self.chat_store.create_chat(chat_id, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
         self.current_chat_id = chat_id
-        self.save_chat_history()
         self.update_chat_list()
         tab_name = f"Chat {len(self.active_chat_tabs) + 1}"
         self.add_chat_tab(tab_name)
@@ -977,35 +3672,90 @@ class AIAssistant:
         self.update_status("Ready", 100, 0)
 
     def load_chat(self, event):
-        self.simulate_progress("Loading chat...", 1)
         selection = self.chat_list.curselection()
         if not selection:
             self.update_status("Ready", 100, 0)
             return
         chat_id = self.chat_list.get(selection[0]).split(" - ")[0].replace("Chat ", "")
+        self.open_chat(chat_id)
+
+    def open_chat(self, chat_id):
         for tab_name, open_chat_id in self.active_chat_tabs.items():
             if open_chat_id == chat_id:
                 self.notebook.select(self.chat_frames[tab_name])
                 self.current_chat_id = chat_id
                 self.update_status("Ready", 100, 0)
-                return
+                return tab_name
         tab_name = f"Chat {len(self.active_chat_tabs) + 1}"
         self.add_chat_tab(tab_name)
         self.active_chat_tabs[tab_name] = chat_id
         self.notebook.select(self.chat_frames[tab_name])
         self.current_chat_id = chat_id
-        chat_display = self.chat_displays[tab_name]
-        chat_display.config(state='normal')
-        chat_display.delete(1.0, tk.END)
-        for msg in self.chats[chat_id]["messages"]:
-            role = msg["role"]
-            content = msg["content"]
-            chat_display.insert(tk.END, f"{role}: {content}\n\n")
-        chat_display.config(state='disabled')
+        # Only the last page is rendered; older messages are read from the store as they scroll into view
+        self.transcripts[tab_name].load(lambda start, end: self.chat_store.messages(chat_id)[start:end],
+                                        len(self.chat_store.messages(chat_id)))
         self.update_status("Ready", 100, 0)
+        return tab_name
+
+    def search_chats(self):
+        query = self.search_var.get().strip()
+        if not query:
+            return
+        start = time.perf_counter()
+        try:
+            self.search_results = self.chat_search.search(query)
+        except sqlite3.OperationalError as e:
+            self.update_status(f"Search error: {str(e)}", 0)
+            return
+        elapsed = (time.perf_counter() - start) * 1000
+        if self.search_window is None or not self.search_window.winfo_exists():
+            self.search_window = tk.Toplevel(self.root)
+            self.search_window.title("Search Chats")
+            self.search_window.geometry("600x300")
+            self.search_list = tk.Listbox(self.search_window)
+            self.search_list.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+            self.search_list.bind('<Double-Button-1>', lambda event: self.open_search_result())
+            self.search_list.bind('<Return>', lambda event: self.open_search_result())
+        self.search_window.title(f"Search Chats: {query}")
+        self.search_list.delete(0, tk.END)
+        for chat_id, msg_index, role, snippet in self.search_results:
+            self.search_list.insert(tk.END, f"Chat {chat_id} #{msg_index + 1} {role}: {' '.join(snippet.split())}")
+        self.search_window.lift()
+        self.update_status(f"{len(self.search_results)} matches for '{query}' ({elapsed:.1f} ms)", 100, 0)
+
+    def open_search_result(self):
+        selection = self.search_list.curselection()
+        if not selection:
+            return
+        chat_id, msg_index, _, _ = self.search_results[selection[0]]
+        if chat_id not in self.chat_store.index:
+            return
+        tab_name = self.open_chat(chat_id)
+        self.jump_to_message(tab_name, chat_id, msg_index)
+
+    def jump_to_message(self, tab_name, chat_id, msg_index):
+        chat_display = self.chat_displays[tab_name]
+        view = self.transcripts[tab_name]
+        mark = f"msg_{msg_index}"
+        if view.fetch is not None and msg_index < view.count and not view.first <= msg_index < view.last:
+            view.show(max(0, msg_index - view.PAGE_MESSAGES // 2))
+        if mark in chat_display.mark_names():
+            start = chat_display.index(mark)
+        else:
+            # Messages shown live (not loaded from the store) have no marks; find the message by its text
+            msg = self.chat_store.messages(chat_id)[msg_index]
+            start = chat_display.search(f"{msg['role']}: {msg['content'][:60]}", "1.0", tk.END)
+            if not start:
+                return
+        chat_display.tag_remove("search_hit", "1.0", tk.END)
+        chat_display.tag_config("search_hit", background="yellow")
+        chat_display.tag_add("search_hit", start, f"{start} lineend")
+        chat_display.see(start)
 
     def process_input(self, tab_name):
-        if not self.current_chat_id:
+        # Each tab answers into its own chat; current_chat_id is only whichever chat was opened last
+        chat_id = self.active_chat_tabs.get(tab_name)
+        if not chat_id:
             self.root.after(0, lambda: tk.messagebox.showwarning("No Chat", "Please start a new chat first."))
             return
         input_field = self.input_fields[tab_name]
@@ -1013,15 +3763,78 @@ class AIAssistant:
         if not user_input:
             return
         self.display_message(tab_name, "User", user_input)
-        self.simulate_progress("Processing query...", 10)
-        response = self.process_query(user_input, tab_name)
-        self.display_message(tab_name, "AI", response)
-        self.chats[self.current_chat_id]["messages"].extend([
-            {"role": "User", "content": user_input},
-            {"role": "AI", "content": response}
-        ])
-        self.save_chat_history()
         input_field.delete(0, tk.END)
+        subject = image_search_query(user_input)
+        if subject:
+            self.find_images(tab_name, chat_id, user_input, subject)
+            return
+        stream_id = self.begin_stream_message(tab_name, "AI")
+        self.update_status("Processing query...", 0)
+
+        def on_token(text):
+            self.root.after(0, self.append_stream_text, stream_id, text)
+
+        def on_done(future):
+            if future.cancelled():
+                # chat_id=None keeps a request that never ran out of the saved history
+                self.finish_stream_message(stream_id, None, user_input, "Cancelled.")
+            elif future.exception():
+                self.finish_stream_message(stream_id, chat_id, user_input, f"Error processing query: {str(future.exception())}")
+            else:
+                self.finish_stream_message(stream_id, chat_id, user_input, future.result())
+
+        request = self.process_query(user_input, tab_name, on_token=on_token, chat_id=chat_id)
+        job = self.submit_job(
+            "chat", tab_name, lambda job: self.run_request(job.request),
+            InferenceScheduler.PRIORITY_INTERACTIVE, on_done, request
+        )
+        if job is None:
+            self.finish_stream_message(stream_id, None, user_input, "Busy, please try again.")
+
+    def find_images(self, tab_name, chat_id, user_input, subject):
+        self.update_status(f"Searching images for '{subject}'...", 0)
+
+        def on_done(future):
+            if future.cancelled():
+                response = "Image search cancelled."
+                paths = []
+            elif future.exception():
+                response = f"Error searching images: {str(future.exception())}"
+                paths = []
+            else:
+                paths = [path for path, _ in future.result()]
+                response = (f"Found {len(paths)} images matching '{subject}': {', '.join(os.path.basename(p) for p in paths)}"
+                            if paths else f"No images matching '{subject}' found.")
+            self.display_message(tab_name, "AI", response)
+            for path in paths:
+                self.show_image(tab_name, path)
+            self.record_messages(chat_id, [
+                {"role": "User", "content": user_input},
+                {"role": "AI", "content": response}
+            ])
+
+        self.submit_job("image_search", tab_name, lambda job: self.search_images(subject),
+                        InferenceScheduler.PRIORITY_INTERACTIVE, on_done)
+
+    def submit_job(self, kind, tab_name, fn, priority, on_done, request=None):
+        def done(future):
+            self.root.after(0, self.job_finished, tab_name, future, on_done)
+        try:
+            job = self.scheduler.submit(kind, fn, priority, tab_name, done, request)
+        except queue.Full:
+            tk.messagebox.showwarning("Busy", "Too many requests are queued. Please wait for one to finish.")
+            return None
+        self.tab_jobs.setdefault(tab_name, []).append(job)
+        return job
+
+    def job_finished(self, tab_name, future, on_done):
+        self.tab_jobs[tab_name] = [job for job in self.tab_jobs.get(tab_name, []) if job.future is not future]
+        if tab_name in self.chat_displays:
+            on_done(future)
+
+    def cancel_tab_jobs(self, tab_name):
+        for job in self.tab_jobs.get(tab_name, []):
+            job.cancel()
 
     def display_message(self, tab_name, role, content):
         chat_display = self.chat_displays[tab_name]
@@ -1030,8 +3843,75 @@ class AIAssistant:
         chat_display.config(state='disabled')
         chat_display.yview(tk.END)
 
+    def show_image(self, tab_name, path):
+        img = Image.open(path)
+        img.thumbnail((200, 200))
+        self.show_photo(tab_name, img, os.path.basename(path))
+
+    def show_images(self, tab_name, paths):
+        if len(paths) == 1:
+            self.show_image(tab_name, paths[0])
+        else:
+            self.show_photo(tab_name, image_grid(paths), f"{len(paths)} images")
+
+    def show_photo(self, tab_name, img, label):
+        photo = ImageTk.PhotoImage(img)
+        chat_display = self.chat_displays[tab_name]
+        chat_display.config(state='normal')
+        self.transcripts[tab_name].add_image(photo, label)
+        chat_display.insert(tk.END, "\n")
+        chat_display.config(state='disabled')
+        chat_display.yview(tk.END)
+
+    def begin_stream_message(self, tab_name, role):
+        # Each reply streams between its own pair of marks, so anything shown in the tab meanwhile (another
+        # reply, an attachment or image result) goes after it and is never swept into or out of it.
+        # The start mark stays left of inserted tokens, the end mark moves right with them.
+        chat_display = self.chat_displays[tab_name]
+        chat_display.config(state='normal')
+        chat_display.insert(tk.END, f"{role}: \n\n")
+        stream_id = next(self.stream_ids)
+        start, end = f"stream_{stream_id}_start", f"stream_{stream_id}_end"
+        # Both marks sit just before the trailing blank line, which keeps later inserts at END outside them
+        chat_display.mark_set(start, "end-3c")
+        chat_display.mark_gravity(start, tk.LEFT)
+        chat_display.mark_set(end, "end-3c")
+        chat_display.mark_gravity(end, tk.RIGHT)
+        chat_display.config(state='disabled')
+        chat_display.yview(tk.END)
+        self.stream_marks[stream_id] = (tab_name, start, end)
+        return stream_id
+
+    def append_stream_text(self, stream_id, text):
+        if stream_id not in self.stream_marks:
+            return
+        tab_name, _, end = self.stream_marks[stream_id]
+        chat_display = self.chat_displays[tab_name]
+        chat_display.config(state='normal')
+        chat_display.insert(end, text)
+        chat_display.config(state='disabled')
+        chat_display.yview(tk.END)
+
+    def finish_stream_message(self, stream_id, chat_id, user_input, response):
+        marks = self.stream_marks.pop(stream_id, None)
+        if marks and marks[0] in self.chat_displays:
+            # Swap the streamed pieces for the final decode so the transcript matches what is saved
+            tab_name, start, end = marks
+            chat_display = self.chat_displays[tab_name]
+            chat_display.config(state='normal')
+            chat_display.delete(start, end)
+            chat_display.insert(start, response)
+            chat_display.mark_unset(start, end)
+            chat_display.config(state='disabled')
+            chat_display.yview(tk.END)
+        self.record_messages(chat_id, [
+            {"role": "User", "content": user_input},
+            {"role": "AI", "content": response}
+        ])
+
     def attach_file(self, tab_name):
-        if not self.current_chat_id:
+        chat_id = self.active_chat_tabs.get(tab_name)
+        if not chat_id:
             self.root.after(0, lambda: tk.messagebox.showwarning("No Chat", "Please start a new chat first."))
             return
         file_path = filedialog.askopenfilename(filetypes=[
@@ -1046,103 +3926,135 @@ class AIAssistant:
         if file_ext in [".exe", ".bat", ".sh"]:
             self.root.after(0, lambda: tk.messagebox.showerror("Security Error", "Executable files not allowed."))
             return
-        self.simulate_progress("Saving attachment...", 2)
         file_name = os.path.basename(file_path).replace("..", "").replace("/", "").replace("\\", "")
         dest_path = os.path.join(ATTACHMENTS_DIR, file_name)
         with open(file_path, 'rb') as src, open(dest_path, 'wb') as dst:
             dst.write(src.read())
-        response = self.process_attachment(file_path, tab_name)
         self.display_message(tab_name, "User", f"Uploaded: {file_name}")
-        self.display_message(tab_name, "AI", response)
-        self.chats[self.current_chat_id]["messages"].extend([
-            {"role": "User", "content": f"Uploaded: {file_name}"},
-            {"role": "AI", "content": response}
-        ])
-        self.save_chat_history()
+        if file_ext in [".png", ".jpg", ".jpeg"]:
+            self.show_image(tab_name, file_path)
+        max_new_tokens = self.reply_length(tab_name)
+
+        def on_done(future):
+            if future.cancelled():
+                response = "Attachment processing cancelled."
+            elif future.exception():
+                response = f"Error processing attachment: {str(future.exception())}"
+            else:
+                response = future.result()
+            self.display_message(tab_name, "AI", response)
+            self.record_messages(chat_id, [
+                {"role": "User", "content": f"Uploaded: {file_name}"},
+                {"role": "AI", "content": response}
+            ])
+
+        self.submit_job(
+            "attachment", tab_name,
+            lambda job: self.process_attachment(dest_path, max_new_tokens),
+            InferenceScheduler.PRIORITY_ATTACHMENT, on_done
+        )
 
-    def process_query(self, query, tab_name):
+    def process_query(self, query, tab_name, on_token=None, chat_id=None):
+        max_new_tokens = self.reply_length(tab_name)
         if "search" in query.lower():
-            return self.deep_search(query, tab_name)
+            return self.deep_search(query, max_new_tokens, on_token, chat_id)
         elif "think" in query.lower() or "reason" in query.lower():
-            return self.deep_think(query, tab_name)
+            return self.deep_think(query, max_new_tokens, on_token, chat_id)
         else:
-            return self.get_model_response(query, tab_name)
+            return self.make_request(query, max_new_tokens, on_token, chat_id)
 
-    def get_model_response(self, query, tab_name):
-        if not self.model or not self.tokenizer:
-            self.update_status("Ready", 100, 0)
-            return "Model not loaded yet."
+    def build_chat_prompt(self, chat_id, query, max_new_tokens, history=None, search_query=None):
+        if history is not None:
+            messages = history
+        else:
+            messages = list(self.chat_store.messages(chat_id)) if chat_id in self.chat_store.index else []
+        # Runs on the worker inside prefill, so dense retrieval may load CLIP here
+        passages = self.retrieval.search(search_query, self.config.get("retrieval_top_k", 4)) if search_query else None
+        return self.context.build(chat_id, messages, query, max_new_tokens, passages)
+
+    def reply_length(self, tab_name):
+        # Reads the tab's Tk variable, so it is called on the Tk thread and the result handed to the job
+        profile = active_profile(self.config)
+        max_new_tokens = profile["max_new_tokens"] if profile else 300
+        if self.chat_length_vars[tab_name].get() == "Short":
+            max_new_tokens //= 2
+        return max_new_tokens
+
+    def make_request(self, query, max_new_tokens, on_token=None, chat_id=None):
+        mode = self.config.get("deterministic_mode", "Off")
+        if mode == "Greedy":
+            return GenerationRequest(query, max_new_tokens, do_sample=False, on_token=on_token, chat_id=chat_id, cacheable=True)
+        if mode == "Seeded":
+            return GenerationRequest(query, max_new_tokens, on_token=on_token, chat_id=chat_id,
+                                     seed=self.config.get("response_seed", 42), cacheable=True)
+        return GenerationRequest(query, max_new_tokens, on_token=on_token, chat_id=chat_id)
+
+    def run_request(self, request):
         try:
-            inputs = self.tokenizer(f"<|user|> {query} <|assistant|> ", return_tensors="pt").to("cpu")
-            max_length = 150 if self.chat_length_vars[tab_name].get() == "Short" else 300
-            outputs = self.model.generate(**inputs, max_length=max_length, num_return_sequences=1, temperature=0.7, do_sample=True)
-            response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-            self.update_status("Ready", 100, 0)
-            return response.replace("<|user|> " + query + " <|assistant|> ", "").strip()
-        except Exception as e:
+            # Held for the whole batch: deep-search prefill may load CLIP mid-batch, and the RAM budget must
+            # not pick TinyLlama (and its KV cache) as the victim while the batch still uses them
+            with self.models.hold("chat"):
+                return self.batcher.run(request)
+        except Exception:
+            # Raised rather than returned as text, so callers (and API clients) can tell a failure from a reply
             self.update_status("Ready", 100, 0)
-            return f"Error processing query: {str(e)}"
+            raise
+
+    def get_model_response(self, query, max_new_tokens, on_token=None, chat_id=None):
+        request = self.make_request(query, max_new_tokens, on_token, chat_id)
+        request.job = self.scheduler.current_job
+        return self.run_request(request)
 
-    def deep_search(self, query, tab_name):
-        self.simulate_progress("Performing deep search...", 15)
-        prompt = f"<|user|> Perform a deep search for: {query}. Analyze and summarize findings as if searching real-time data. <|assistant|> "
-        return self.get_model_response(prompt, tab_name)
+    def deep_search(self, query, max_new_tokens, on_token=None, chat_id=None):
+        # The top passages from attachments and past chats are retrieved at prefill and placed before the question
+        request = self.make_request(query, max_new_tokens, on_token, chat_id)
+        request.search_query = query
+        return request
 
-    def deep_think(self, query, tab_name):
-        self.simulate_progress("Deep thinking...", 20)
+    def deep_think(self, query, max_new_tokens, on_token=None, chat_id=None):
         prompt = f"<|user|> Analyze and reason deeply about: {query}. Break down the problem step-by-step, consider multiple approaches, and provide a detailed, reasoned answer. <|assistant|> "
-        return self.get_model_response(prompt, tab_name)
+        return self.make_request(prompt, max_new_tokens, on_token, chat_id)
 
-    def process_attachment(self, file_path, tab_name):
-        self.simulate_progress("Processing attachment...", 2)
+    def process_attachment(self, file_path, max_new_tokens):
         file_ext = os.path.splitext(file_path)[1].lower()
         if file_ext == ".txt":
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+            content = read_attachment_text(file_path)
+            self.retrieval.add_attachment(file_path, content)
             self.update_status("Ready", 100, 0)
             return f"Processed TXT file: {os.path.basename(file_path)}\nContent preview: {content[:100]}..."
         elif file_ext == ".pdf":
             try:
-                with open(file_path, 'rb') as f:
-                    reader = PyPDF2.PdfReader(f)
-                    text = ""
-                    for page in reader.pages:
-                        text += page.extract_text() or ""
+                text = read_attachment_text(file_path, self.update_status)
+                self.retrieval.add_attachment(file_path, text)
                 self.update_status("Ready", 100, 0)
                 return f"Processed PDF file: {os.path.basename(file_path)}\nContent preview: {text[:100]}..."
             except Exception as e:
                 self.update_status("Ready", 100, 0)
                 return f"Error processing PDF: {str(e)}"
         elif file_ext in [".png", ".jpg", ".jpeg"]:
-            img = Image.open(file_path)
-            img.thumbnail((200, 200))
-            photo = ImageTk.PhotoImage(img)
-            self.chat_displays[tab_name].image_create(tk.END, image=photo)
-            self.chat_displays[tab_name].insert(tk.END, "\n")
-            self.chat_displays[tab_name].image = photo
-            if self.clip_model and self.clip_processor:
-                try:
-                    image = Image.open(file_path).convert("RGB")
-                    inputs = self.clip_processor(images=image, return_tensors="pt")
-                    image_features = self.clip_model.get_image_features(**inputs)
+            try:
+                # A file seen before (same content, any name) costs one hash and no CLIP or LLM call
+                content_hash = self.image_store.ensure([file_path], self.encode_images)[0]
+                description = self.image_store.description(content_hash)
+                if description is None:
+                    features = self.image_store.vector(content_hash)
                     description = self.get_model_response(
-                        f"Describe this image based on its features: {image_features.tolist()[:10]}",
-                        tab_name
+                        f"Describe this image based on its features: {[round(float(x), 4) for x in features[:10]]}",
+                        max_new_tokens
                     )
-                    self.update_status("Ready", 100, 0)
-                    return f"Processed image file: {os.path.basename(file_path)}\nImage displayed above.\nDescription: {description}"
-                except Exception as e:
-                    self.update_status("Ready", 100, 0)
-                    return f"Processed image file: {os.path.basename(file_path)}\nImage displayed above.\nError analyzing image: {str(e)}"
-            else:
+                    self.image_store.set_description(content_hash, description)
                 self.update_status("Ready", 100, 0)
-                return f"Processed image file: {os.path.basename(file_path)}\nImage displayed above.\nVision model not loaded."
+                return f"Processed image file: {os.path.basename(file_path)}\nImage displayed above.\nDescription: {description}"
+            except Exception as e:
+                self.update_status("Ready", 100, 0)
+                return f"Processed image file: {os.path.basename(file_path)}\nImage displayed above.\nError analyzing image: {str(e)}"
         else:
             self.update_status("Ready", 100, 0)
             return "Unsupported file type."
 
     def generate_image(self, tab_name):
-        if not self.current_chat_id:
+        chat_id = self.active_chat_tabs.get(tab_name)
+        if not chat_id:
             self.root.after(0, lambda: tk.messagebox.showwarning("No Chat", "Please start a new chat first."))
             return
         input_field = self.input_fields[tab_name]
@@ -1150,56 +4062,179 @@ class AIAssistant:
         if not prompt:
             self.root.after(0, lambda: tk.messagebox.showwarning("No Prompt", "Please enter a prompt to generate an image."))
             return
-        if not self.image_pipe:
-            self.root.after(0, lambda: tk.messagebox.showwarning("Image Model", "Image generation model not loaded yet."))
+        prompts, seed = parse_image_prompt(prompt)
+        if not prompts:
+            self.root.after(0, lambda: tk.messagebox.showwarning("No Prompt", "Please enter a prompt to generate an image."))
             return
-        eta = 15 if self.config["image_quality"] == "Low" else 30
-        steps = 10 if self.config["image_quality"] == "Low" else 20
-        self.simulate_progress("Generating image...", eta)
         try:
-            image = self.image_pipe(prompt, num_inference_steps=steps).images[0]
-            img_path = os.path.join(GENERATED_IMAGES_DIR, f"generated_{len(os.listdir(GENERATED_IMAGES_DIR)) + 1}.png")
-            image.save(img_path)
-            img = Image.open(img_path)
-            img.thumbnail((200, 200))
-            photo = ImageTk.PhotoImage(img)
-            self.display_message(tab_name, "AI", f"Generated image for prompt: {prompt}")
-            self.chat_displays[tab_name].image_create(tk.END, image=photo)
-            self.chat_displays[tab_name].insert(tk.END, "\n")
-            self.chat_displays[tab_name].image = photo
-            self.chats[self.current_chat_id]["messages"].extend([
+            count = max(1, min(int(self.image_count_vars[tab_name].get()), 8))
+        except ValueError:
+            count = 1
+        total = len(prompts) * count
+        if seed is None:
+            seed = self.config.get("response_seed", 42) if self.config.get("deterministic_mode", "Off") != "Off" else random.randrange(2 ** 31 - total)
+        # One seed per image, so any single result can be regenerated with "seed:N"
+        seeds = [seed + i for i in range(total)]
+        steps, size = choose_image_settings(self.config)
+        negative_prompt = self.config.get("image_negative_prompt", "")
+        input_field.delete(0, tk.END)
+        self.display_message(tab_name, "User", f"Generate image: {prompt}")
+        ahead = self.scheduler.pending_kind("image") + (self.scheduler.current_job is not None and self.scheduler.current_job.kind == "image")
+        self.update_status(f"Image queued ({ahead} ahead)" if ahead else "Generating image...", 0)
+
+        def run(job):
+            images = self.run_image_pipeline(job, prompts, steps, size, count, seeds, negative_prompt)
+            # Named by job rather than by counting files, so queued jobs never pick the same name
+            stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+            paths = []
+            for i, image in enumerate(images):
+                img_path = os.path.join(GENERATED_IMAGES_DIR, f"generated_{stamp}_{job.seq}" + (f"_{i + 1}" if len(images) > 1 else "") + ".png")
+                image.save(img_path)
+                paths.append(img_path)
+            return paths
+
+        def on_done(future):
+            self.update_status("Ready", 100, 0)
+            if future.cancelled() or isinstance(future.exception(), JobCancelled):
+                self.display_message(tab_name, "AI", "Image generation cancelled.")
+                return
+            if future.exception():
+                self.display_message(tab_name, "AI", f"Error generating image: {str(future.exception())}")
+                return
+            paths = future.result()
+            if len(paths) == 1:
+                response = f"Generated image for prompt: {prompt} (seed {seeds[0]})"
+            else:
+                response = (f"Generated {len(paths)} images for prompt: {prompt} (seeds {seeds[0]}-{seeds[-1]}): "
+                            + ", ".join(os.path.basename(path) for path in paths))
+            self.display_message(tab_name, "AI", response)
+            self.show_images(tab_name, paths)
+            self.record_messages(chat_id, [
                 {"role": "User", "content": f"Generate image: {prompt}"},
-                {"role": "AI", "content": f"Generated image for prompt: {prompt}"}
+                {"role": "AI", "content": response}
             ])
-            self.save_chat_history()
-        except Exception as e:
-            self.display_message(tab_name, "AI", f"Error generating image: {str(e)}")
-            self.update_status("Ready", 100, 0)
+
+        self.submit_job("image", tab_name, run, InferenceScheduler.PRIORITY_BACKGROUND, on_done)
+
+    def prompt_embeddings(self, prompts, negative_prompt):
+        # CLIP text-encoder output per normalized prompt, so repeats and variations of a prompt skip encoding
+        positives, negatives = [], []
+        for prompt in prompts:
+            key = (prompt, negative_prompt)
+            if key in self.prompt_embeds:
+                self.prompt_embeds.move_to_end(key)
+            else:
+                with torch.no_grad():
+                    self.prompt_embeds[key] = self.image_pipe.encode_prompt(prompt, "cpu", 1, True, negative_prompt=negative_prompt or None)
+                while len(self.prompt_embeds) > PROMPT_EMBED_CACHE_SIZE:
+                    self.prompt_embeds.popitem(last=False)
+            positive, negative = self.prompt_embeds[key]
+            positives.append(positive)
+            negatives.append(negative)
+        return torch.cat(positives), torch.cat(negatives)
+
+    def run_image_pipeline(self, job, prompts, steps, size=512, num_images=1, seeds=None, negative_prompt=""):
+        # A diffusion run takes minutes on CPU, so chats and attachments queued meanwhile are answered
+        # between its steps instead of waiting for it; the pipeline is held so they cannot unload it.
+        # Up to image_batch_size images share each UNet pass. Results come back prompt by prompt,
+        # num_images each, with seeds[i] driving image i. Seeded images already in the result cache are
+        # returned as stored; when all of them are, Stable Diffusion is not even loaded.
+        prompts = [normalize_prompt(prompt) for prompt in ([prompts] if isinstance(prompts, str) else prompts)]
+        negative_prompt = normalize_prompt(negative_prompt)
+        entries = [(prompt, seeds[i] if seeds else None) for i, prompt in enumerate(p for p in prompts for _ in range(num_images))]
+        model_id = f"{MODEL_SOURCES['image'][0]}@{self.registry.revision('image')}"
+
+        def make_keys(variant):
+            return [ImageResultCache.make_key(model_id, prompt, negative_prompt, seed, steps, variant, size) if seed is not None else None
+                    for prompt, seed in entries]
+        # A loaded pipeline keeps its preset until the queued reload after a preset change, so it decides the key;
+        # otherwise the pipeline that would be loaded now does
+        variant = self.image_variant or preset_variant(self.config, choose_image_preset(self.config))
+        keys = make_keys(variant)
+        images = [self.image_cache.get(key) if key else None for key in keys]
+        todo = [i for i, image in enumerate(images) if image is None]
+        if not todo:
+            self.update_status(f"Image cache hit ({len(images)} images; hits {self.image_cache.hits} / misses {self.image_cache.misses})", 100, 0)
+            return images
+        batch_size = max(1, self.config.get("image_batch_size", 2))
+        batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+
+        def on_step_end(pipe, step, timestep, callback_kwargs):
+            if job.cancelled:
+                raise JobCancelled()
+            tracker.advance()
+            if self.scheduler.pending():
+                started = time.time()
+                self.scheduler.run_waiting(job.priority, job.kind)
+                waited[0] += time.time() - started
+                tracker.report(force=True)
+            return callback_kwargs
+        waited = [0.0]
+        stats = {}
+        with self.models.hold("image"), measure_load(stats):
+            if self.image_variant != variant:
+                # The pipeline was (re)loaded under different settings since the lookup; store under what renders
+                keys = make_keys(self.image_variant)
+            label = f"Generating {len(todo)} images" if len(todo) > 1 else f"Generating image '{entries[todo[0]][0][:30]}'"
+            tracker = ProgressTracker(label, steps * len(batches), self.update_status, "steps")
+            for batch in batches:
+                # Equal runs of the same prompt go through num_images_per_prompt with one embedding each
+                batch_prompts = [entries[i][0] for i in batch]
+                unique = list(dict.fromkeys(batch_prompts))
+                per_prompt = len(batch) // len(unique)
+                if batch_prompts != [prompt for prompt in unique for _ in range(per_prompt)]:
+                    unique, per_prompt = batch_prompts, 1
+                prompt_embeds, negative_prompt_embeds = self.prompt_embeddings(unique, negative_prompt)
+                generator = [torch.Generator().manual_seed(entries[i][1]) for i in batch] if seeds else None
+                result = self.image_pipe(prompt_embeds=prompt_embeds, negative_prompt_embeds=negative_prompt_embeds, num_images_per_prompt=per_prompt,
+                                         num_inference_steps=steps, height=size, width=size, generator=generator, callback_on_step_end=on_step_end)
+                for i, image in zip(batch, result.images):
+                    images[i] = image
+                    if keys[i]:
+                        self.image_cache.put(keys[i], image)
+        # Time spent answering other jobs between steps is not the preset's; their RSS does count toward the peak
+        self.root.after(0, self.image_preset_measured, self.image_preset, {
+            "seconds_per_image": round((stats["load_seconds"] - waited[0]) / len(todo), 1),
+            "peak_rss_mb": stats["peak_rss_mb"], "steps": steps, "size": size, "batch": min(batch_size, len(todo))
+        })
+        return images
 
     def delete_everything(self):
         def perform_delete():
-            self.simulate_progress("Deleting all data...", 2)
-            self.chats = {}
+            for tab_name in list(self.tab_jobs):
+                self.cancel_tab_jobs(tab_name)
+            self.tab_jobs = {}
+            self.stream_marks = {}
+            self.kv_cache.drop()
+            self.response_cache.clear()
+            self.image_cache.clear()
+            self.retrieval.clear()
+            self.image_store.clear()
+            self.chat_search.clear()
+            if self.context:
+                self.context.reset()
             self.current_chat_id = None
             self.active_chat_tabs = {}
             for tab_name in list(self.chat_frames.keys()):
                 self.notebook.forget(self.chat_frames[tab_name])
             self.chat_frames = {}
             self.chat_displays = {}
+            self.transcripts = {}
             self.input_fields = {}
             self.chat_length_vars = {}
+            self.image_count_vars = {}
             self.settings_frame = tk.Frame(self.notebook)
             self.notebook.add(self.settings_frame, text="Settings")
             self.create_settings_tab()
             self.video_frame = tk.Frame(self.notebook)
             self.notebook.add(self.video_frame, text="Video Editor")
-            self.video_app = VideoApp(self.video_frame)
+            self.video_app = VideoApp(self.video_frame, self.update_status)
             self.games_frame = tk.Frame(self.notebook)
             self.notebook.add(self.games_frame, text="Games")
             self.create_games_tab()
             self.add_chat_tab("Chat 1")
             self.notebook.select(self.chat_frames["Chat 1"])
-            self.save_chat_history()
+            self.chat_store.clear()
             self.update_chat_list()
             self.chat_displays["Chat 1"].config(state='normal')
             self.chat_displays["Chat 1"].delete(1.0, tk.END)
@@ -1213,8 +4248,6 @@ class AIAssistant:
             os.makedirs(ATTACHMENTS_DIR, exist_ok=True)
             os.makedirs(GENERATED_IMAGES_DIR, exist_ok=True)
             os.makedirs(VIDEO_TEMP_DIR, exist_ok=True)
-            with open(CHAT_HISTORY_FILE, 'w') as f:
-                json.dump({"chats": {}}, f)
             self.update_status("Ready", 100, 0)
             self.root.after(0, lambda: tk.messagebox.showinfo("Success", "All data deleted."))
 
@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+MODULES = ["tkinter", "PIL.ImageTk", "psutil", "tkinterdnd2", "numpy", "cv2", "PyPDF2", "torch", "transformers", "diffusers", "main"]
+
+# Child script for one cold start. It imports main and paints the settings window, then presses
+# Start and paints the main window. It reports wall-clock times. The parent subtracts its own launch
+# time, so interpreter startup is included.
+WINDOW_PROBE = """
+import json, sys, time
+sys.path.insert(0, {app_dir!r})
+import main
+result = {{"main_imported": time.time()}}
+
+def paint(root):
+    root.update()
+    root.wait_visibility(root)
+    root.update_idletasks()
+    return time.time()
+
+def open_main_window(config):
+    root = main.tkdnd.TkinterDnD.Tk() if main.TKDND_AVAILABLE else main.tk.Tk()
+    main.AIAssistant(root, config)
+    result["main_painted"] = paint(root)
+    root.destroy()
+
+root = main.tkdnd.TkinterDnD.Tk() if main.TKDND_AVAILABLE else main.tk.Tk()
+settings = main.SettingsGUI(root, open_main_window)
+result["settings_painted"] = paint(root)
+result["start_pressed"] = time.time()
+settings.start()
+result["heavy_modules_loaded"] = sorted(name for name in ("torch", "transformers", "diffusers", "cv2", "PyPDF2") if name in sys.modules)
+print(json.dumps(result))
+"""
+
+def import_time(module, workdir):
+    # Fresh interpreter per sample; "main" creates its data folders, so run it in a scratch directory
+    code = f"import sys, time; sys.path.insert(0, {APP_DIR!r}); start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=workdir)
+    if result.returncode != 0:
+        return None
+    return float(result.stdout.strip().splitlines()[-1])
+
+def time_to_first_window(workdir):
+    start = time.time()
+    result = subprocess.run([sys.executable, "-c", WINDOW_PROBE.format(app_dir=APP_DIR)], capture_output=True, text=True, cwd=workdir)
+    if result.returncode != 0:
+        return None, result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed"
+    probe = json.loads(result.stdout.strip().splitlines()[-1])
+    return {
+        "import_main_s": probe["main_imported"] - start,
+        "settings_window_s": probe["settings_painted"] - start,
+        "main_window_after_start_s": probe["main_painted"] - probe["start_pressed"],
+        "heavy_modules_loaded": probe["heavy_modules_loaded"]
+    }, None
+
+def summarize(samples):
+    samples = [sample for sample in samples if sample is not None]
+    if not samples:
+        return None
+    return {"median_s": round(statistics.median(samples), 4), "min_s": round(min(samples), 4), "max_s": round(max(samples), 4)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure OmniCore cold-start import times and time-to-first-window.")
+    parser.add_argument("--runs", type=int, default=5, help="cold starts per measurement (default 5)")
+    parser.add_argument("--json", dest="json_path", help="also write the report to this JSON file")
+    parser.add_argument("--skip-windows", action="store_true", help="only measure imports (no display needed)")
+    args = parser.parse_args()
+
+    report = {"python": sys.version.split()[0], "platform": sys.platform, "runs": args.runs, "imports": {}, "windows": {}}
+    with tempfile.TemporaryDirectory() as workdir:
+        for module in MODULES:
+            report["imports"][module] = summarize([import_time(module, workdir) for _ in range(args.runs)])
+            timing = report["imports"][module]
+            print(f"import {module:<20} " + ("not installed" if timing is None else f"{timing['median_s'] * 1000:8.1f} ms (median)"))
+        if not args.skip_windows:
+            samples, error = [], None
+            for _ in range(args.runs):
+                sample, error = time_to_first_window(workdir)
+                if sample is None:
+                    break
+                samples.append(sample)
+            if samples:
+                for key in ("import_main_s", "settings_window_s", "main_window_after_start_s"):
+                    report["windows"][key[:-2]] = summarize([sample[key] for sample in samples])
+                    print(f"{key[:-2]:<26} {report['windows'][key[:-2]]['median_s'] * 1000:8.1f} ms (median)")
+                report["windows"]["heavy_modules_loaded"] = samples[-1]["heavy_modules_loaded"]
+                print(f"heavy modules loaded by then: {', '.join(samples[-1]['heavy_modules_loaded']) or 'none'}")
+            else:
+                report["windows"]["error"] = error
+                print(f"window probe failed: {error}")
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"Report written to {args.json_path}")
+
+if __name__ == "__main__":
+    main()